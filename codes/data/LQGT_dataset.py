@@ -54,8 +54,8 @@ class LQGTDataset(data.Dataset):
         else:
             resolution = None
         img_GT = util.read_img(self.GT_env, GT_path, resolution)
-        # modcrop in the validation / test phase
-        if self.opt['phase'] != 'train':
+        # modcrop in the validation / test phase, unless the model pads to the scale (pad_mode)
+        if self.opt['phase'] != 'train' and not self.opt['pad_mode']:
             img_GT = util.modcrop(img_GT, scale)
         # change color space if necessary
         if self.opt['color']:
@@ -127,8 +127,13 @@ class LQGTDataset(data.Dataset):
         if img_GT.shape[2] == 3:
             img_GT = img_GT[:, :, [2, 1, 0]]
             img_LQ = img_LQ[:, :, [2, 1, 0]]
-        img_GT = torch.from_numpy(np.ascontiguousarray(np.transpose(img_GT, (2, 0, 1)))).float()
-        img_LQ = torch.from_numpy(np.ascontiguousarray(np.transpose(img_LQ, (2, 0, 1)))).float()
+        if self.opt['channels_last']:
+            # CHW views of the HWC arrays, batched as NHWC by channels_last_collate
+            img_GT = torch.from_numpy(np.ascontiguousarray(img_GT)).permute(2, 0, 1).float()
+            img_LQ = torch.from_numpy(np.ascontiguousarray(img_LQ)).permute(2, 0, 1).float()
+        else:
+            img_GT = torch.from_numpy(np.ascontiguousarray(np.transpose(img_GT, (2, 0, 1)))).float()
+            img_LQ = torch.from_numpy(np.ascontiguousarray(np.transpose(img_LQ, (2, 0, 1)))).float()
 
         if LQ_path is None:
             LQ_path = GT_path
@@ -4,8 +4,20 @@ import torch
 import torch.utils.data
 
 
+def channels_last_collate(batch):
+    '''default_collate that stacks the image tensors into channels_last (NHWC) batches'''
+    out = {}
+    for key in batch[0]:
+        if torch.is_tensor(batch[0][key]) and batch[0][key].dim() == 3:
+            out[key] = torch.stack([b[key].permute(1, 2, 0) for b in batch]).permute(0, 3, 1, 2)
+        else:
+            out[key] = torch.utils.data.default_collate([b[key] for b in batch])
+    return out
+
+
 def create_dataloader(dataset, dataset_opt, opt=None, sampler=None):
     phase = dataset_opt['phase']
+    collate_fn = channels_last_collate if dataset_opt['channels_last'] else None
     if phase == 'train':
         if opt['dist']:
             world_size = torch.distributed.get_world_size()
@@ -19,10 +31,10 @@ def create_dataloader(dataset, dataset_opt, opt=None, sampler=None):
             shuffle = True
         return torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=shuffle,
                                            num_workers=num_workers, sampler=sampler, drop_last=True,
-                                           pin_memory=False)
+                                           pin_memory=False, collate_fn=collate_fn)
     else:
         return torch.utils.data.DataLoader(dataset, batch_size=1, shuffle=False, num_workers=1,
-                                           pin_memory=True)
+                                           pin_memory=True, collate_fn=collate_fn)
 
 
 def create_dataset(dataset_opt):
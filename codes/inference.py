@@ -0,0 +1,102 @@
+'''Downscale or upscale a folder of images with a trained IRN model, no dataset needed.
+
+    python inference.py -opt options/test/test_IRN_x4.yml -input HR/ -output LR/ -mode downscale
+    python inference.py -opt options/test/test_IRN_x4.yml -input LR/ -output SR/ -mode upscale
+    python inference.py -opt options/test/test_IRN_x4.yml -input HR/ -output LR/ \\
+        -memory_MB 2048 -batch 16
+'''
+import os.path as osp
+import logging
+import time
+import argparse
+
+import numpy as np
+import torch
+import options.options as option
+import utils.util as util
+import data.util as data_util
+from models import create_model
+
+
+def img2tensor(img):
+    '''HWC BGR [0,1] numpy image -> 1CHW RGB tensor'''
+    if img.shape[2] == 3:
+        img = img[:, :, [2, 1, 0]]
+    return torch.from_numpy(np.ascontiguousarray(np.transpose(img, (2, 0, 1)))).float()[None]
+
+
+def load_model(opt_path, model_path=None, compile_backend=None, cpu=False, memory_MB=None):
+    opt = option.parse(opt_path, is_train=False)
+    opt = option.dict_to_nonedict(opt)
+    if cpu:
+        opt['gpu_ids'] = None
+    if model_path:
+        opt['path']['pretrain_model_G'] = model_path
+    if opt['test'] is None:
+        opt['test'] = option.NoneDict()
+    if compile_backend:
+        opt['test']['compile'] = compile_backend
+    if memory_MB:
+        opt['test']['memory_budget_MB'] = memory_MB
+    return opt, create_model(opt)
+
+
+def downscale(model, img):
+    '''HR numpy image -> quantized LR numpy image, sizes that are not multiples of the
+    scale are padded (test: pad_mode) to an LR of ceil(H / scale) x ceil(W / scale)'''
+    LR = model.downscale(img2tensor(img).to(model.device))
+    return util.tensor2img(LR[0])
+
+
+def upscale(model, img, gaussian_scale=1, seed=None):
+    '''LR numpy image -> HR numpy image'''
+    HR = model.upscale(img2tensor(img).to(model.device), model.opt['scale'], gaussian_scale, seed)
+    return util.tensor2img(HR[0])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-opt', type=str, required=True, help='Path to options YMAL file.')
+    parser.add_argument('-model', type=str, default=None, help='Override pretrain_model_G.')
+    parser.add_argument('-input', type=str, required=True, help='Image file or folder.')
+    parser.add_argument('-output', type=str, required=True, help='Output folder.')
+    parser.add_argument('-mode', type=str, default='downscale', choices=['downscale', 'upscale'])
+    parser.add_argument('-compile', type=str, default=None, choices=['inductor', 'trace'],
+                        help='Run netG through compiled graphs.')
+    parser.add_argument('-gaussian_scale', type=float, default=1.)
+    parser.add_argument('-seed', type=int, default=None, help='Seed of the latent draws.')
+    parser.add_argument('-memory_MB', type=float, default=None,
+                        help='Activation budget, picks the tile size and the batch '
+                        '(test: memory_budget_MB).')
+    parser.add_argument('-batch', type=int, default=1,
+                        help='Images per call, run in the largest batches within -memory_MB.')
+    parser.add_argument('-cpu', action='store_true')
+    args = parser.parse_args()
+
+    util.setup_logger('base', args.output, 'inference', level=logging.INFO, screen=True)
+    logger = logging.getLogger('base')
+    util.mkdir(args.output)
+    opt, model = load_model(args.opt, args.model, args.compile, args.cpu, args.memory_MB)
+
+    if osp.isdir(args.input):
+        paths = data_util._get_paths_from_images(args.input)
+    else:
+        paths = [args.input]
+    for i in range(0, len(paths), args.batch):
+        batch = paths[i:i + args.batch]
+        imgs = [img2tensor(data_util.read_img(None, path)).to(model.device) for path in batch]
+        start = time.time()
+        with torch.no_grad():
+            if args.mode == 'downscale':
+                outs = model.downscale(imgs)
+            else:
+                outs = model.upscale(imgs, model.opt['scale'], args.gaussian_scale, args.seed)
+        names = ', '.join(osp.basename(path) for path in batch)
+        logger.info('{:s} {:s} in {:.3f}s'.format(names, args.mode, time.time() - start))
+        for path, out in zip(batch, outs):
+            save_path = osp.join(args.output, osp.splitext(osp.basename(path))[0] + '.png')
+            util.save_img(util.tensor2img(out[0]), save_path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,229 @@
+'''IRN inference with NumPy only, for batch jobs and machines without torch.
+
+A *_G.pth checkpoint is converted once (this step needs torch) to a .npz file holding
+the conv weights and the layout of the network. Running it afterwards only imports
+numpy, plus Pillow to read and write images from the command line.
+
+    python inference_numpy.py -convert ../experiments/pretrained_models/IRN_x4.pth \\
+        -output IRN_x4.npz
+    python inference_numpy.py -model IRN_x4.npz -input HR/ -output LR/ -mode downscale
+    python inference_numpy.py -model IRN_x4.npz -input LR/ -output SR/ -mode upscale
+
+Activations are kept in NHWC and every 3x3 conv is one matrix product over a padded
+buffer, so the speed mostly depends on the BLAS numpy is linked against.
+'''
+import os
+import os.path as osp
+import argparse
+import json
+import re
+import time
+
+import numpy as np
+
+# signs of the b, c, d taps in the four Haar subbands, as in Inv_arch._HAAR_SIGNS
+_HAAR_SIGNS = ((1, 1, 1), (-1, 1, -1), (1, -1, -1), (-1, -1, 1))
+
+
+def convert(model_path, out_path, half=False):
+    '''*_G.pth state_dict -> .npz with the conv weights as C_in x (9 * C_out) matrices.
+    half stores them as float16 (half the file size), they are computed in float32.'''
+    import torch
+    state_dict = torch.load(model_path, map_location='cpu')
+    if 'state_dict' in state_dict:
+        state_dict = state_dict['state_dict']
+    layout = []
+    arrays = {}
+    for k, v in state_dict.items():
+        k = k[7:] if k.startswith('module.') else k
+        m = re.match(r'operations\.(\d+)\.(.*)', k)
+        if m is None:
+            raise ValueError('Unexpected key [{:s}] in {:s}, expected an InvRescaleNet state_dict '
+                             '(operations.<i>.*).'.format(k, model_path))
+        i, name = int(m.group(1)), m.group(2)
+        if name.endswith('pruned_widths'):
+            continue  # the widths of pruned subnets follow from their weights
+        while len(layout) <= i:
+            layout.append(None)
+        if name == 'haar_weights':
+            layout[i] = {'type': 'haar', 'channel_in': v.shape[0] // 4}
+            continue
+        if name.startswith('GH.'):
+            raise ValueError('Save the model with fuse_gh: false to convert it.')
+        if layout[i] is None:
+            layout[i] = {'type': 'block'}
+        v = v.float().numpy()
+        if v.ndim == 4:  # OIHW -> I x (kh, kw, O), see _conv3x3
+            if name.endswith('F.conv5.weight'):
+                layout[i]['split_len1'] = v.shape[0]
+            v = v.transpose(1, 2, 3, 0).reshape(v.shape[1], -1)
+        arrays['{}.{}'.format(i, name)] = v.astype(np.float16 if half else np.float32)
+    arrays['layout'] = np.frombuffer(json.dumps(layout).encode(), dtype=np.uint8)
+    np.savez(out_path, **arrays)
+
+
+class NumpyIRN(object):
+    '''InvRescaleNet (DBNet subnets, clamp 1) on NumPy arrays.
+    Inputs and outputs are NCHW float32 like the torch model.'''
+    def __init__(self, path):
+        data = np.load(path)
+        self.layout = json.loads(data['layout'].tobytes().decode())
+        self.weights = {k: data[k].astype(np.float32) for k in data.files if k != 'layout'}
+        self.down_num = sum(op['type'] == 'haar' for op in self.layout)
+        self.scale = 2**self.down_num
+        self.clamp = 1.
+
+    def forward(self, x, rev=False):
+        x = np.ascontiguousarray(x.transpose(0, 2, 3, 1), dtype=np.float32)
+        order = range(len(self.layout)) if not rev else reversed(range(len(self.layout)))
+        for i in order:
+            x = self._op(i, x, rev)
+        return x.transpose(0, 3, 1, 2)
+
+    def downscale(self, x, channels=3):
+        '''forward(x)[:, :channels], the last block only computes its y1 half'''
+        x = np.ascontiguousarray(x.transpose(0, 2, 3, 1), dtype=np.float32)
+        last = len(self.layout) - 1
+        op = self.layout[last]
+        y1_only = op['type'] == 'block' and channels <= op['split_len1']
+        for i in range(last if y1_only else last + 1):
+            x = self._op(i, x, False)
+        if y1_only:
+            split = self.layout[last]['split_len1']
+            x = x[..., :split] + self._dense(last, 'F', x[..., split:])
+        return x[..., :channels].transpose(0, 3, 1, 2)
+
+    def upscale(self, lr, z=None, gaussian_scale=1, seed=None):
+        '''LR (N, 3, h, w) -> HR (N, 3, h * scale, w * scale), z drawn if not given'''
+        N, C, h, w = lr.shape
+        if z is None:
+            rng = np.random.default_rng(seed)
+            z = gaussian_scale * rng.standard_normal((N, C * (self.scale**2 - 1), h, w), np.float32)
+        return self.forward(np.concatenate((lr, z), 1), rev=True)[:, :C]
+
+    def _op(self, i, x, rev):
+        if self.layout[i]['type'] == 'haar':
+            return _haar_reverse(x) if rev else _haar_forward(x)
+
+        split = self.layout[i]['split_len1']
+        x1, x2 = x[..., :split], x[..., split:]
+        if not rev:
+            y1 = x1 + self._dense(i, 'F', x2)
+            g, h = self._dense(i, 'G', y1), self._dense(i, 'H', y1)
+            y2 = x2 * np.exp(self.clamp * np.tanh(h / 2)) + g  # sigmoid(h) * 2 - 1 == tanh(h / 2)
+        else:
+            g, h = self._dense(i, 'G', x1), self._dense(i, 'H', x1)
+            y2 = (x2 - g) / np.exp(self.clamp * np.tanh(h / 2))
+            y1 = x1 - self._dense(i, 'F', y2)
+        return np.concatenate((y1, y2), -1)
+
+    def _dense(self, i, name, x):
+        # all features live in one zero-padded buffer [x, x1, x2, x3, x4], each conv
+        # reads a channel prefix of it, so there is no concatenation and no padding copy
+        prefix = '{}.{}.'.format(i, name)
+        ws = [self.weights[prefix + 'conv{}.weight'.format(k)] for k in range(1, 6)]
+        bs = [self.weights.get(prefix + 'conv{}.bias'.format(k)) for k in range(1, 6)]
+        N, H, W, c = x.shape
+        total = ws[-1].shape[0]
+        buf = np.zeros((N, H + 2, W + 2, total), dtype=np.float32)
+        buf[:, 1:-1, 1:-1, :c] = x
+        flat = buf.reshape(-1, total)
+        for w, b in zip(ws[:4], bs[:4]):
+            out = _conv3x3(flat[:, :c], w, b, buf.shape[:3])
+            gc = out.shape[-1]
+            buf[:, 1:-1, 1:-1, c:c + gc] = np.maximum(out, 0.2 * out)  # LeakyReLU(0.2)
+            c += gc
+        return _conv3x3(flat, ws[4], bs[4], buf.shape[:3])
+
+
+def _conv3x3(flat, w, b, shape):
+    '''3x3 conv, stride 1, on the flattened zero-padded NHWC buffer flat (rows = padded pixels).
+    One matrix product gives the response of every input pixel to each of the 9 taps,
+    the output sums them with the tap offsets. Returns the N x H x W interior.'''
+    N, Hp, Wp = shape
+    C_out = w.shape[1] // 9
+    r = (flat @ w).reshape(N, Hp, Wp, 9, C_out)
+    H, W = Hp - 2, Wp - 2
+    out = r[:, :H, :W, 0].copy()
+    for t in range(1, 9):
+        kh, kw = divmod(t, 3)
+        out += r[:, kh:kh + H, kw:kw + W, t]
+    if b is not None:
+        out += b
+    return out
+
+
+def _haar_forward(x):
+    N, H, W, C = x.shape
+    x = x.reshape(N, H // 2, 2, W // 2, 2, C)
+    a, b = x[:, :, 0, :, 0], x[:, :, 0, :, 1]
+    c, d = x[:, :, 1, :, 0], x[:, :, 1, :, 1]
+    out = np.empty((N, H // 2, W // 2, 4, C), dtype=x.dtype)
+    for k, (sb, sc, sd) in enumerate(_HAAR_SIGNS):
+        out[:, :, :, k] = (a + sb * b + sc * c + sd * d) / 4
+    return out.reshape(N, H // 2, W // 2, 4 * C)
+
+
+def _haar_reverse(x):
+    N, H, W, C = x.shape
+    x = x.reshape(N, H, W, 4, C // 4)
+    ll, lh, hl, hh = x[:, :, :, 0], x[:, :, :, 1], x[:, :, :, 2], x[:, :, :, 3]
+    out = np.empty((N, H, 2, W, 2, C // 4), dtype=x.dtype)
+    for k, (s1, s2, s3) in enumerate(_HAAR_SIGNS):
+        out[:, :, k // 2, :, k % 2] = ll + s1 * lh + s2 * hl + s3 * hh
+    return out.reshape(N, H * 2, W * 2, C // 4)
+
+
+def read_image(path):
+    '''RGB image file -> 1CHW float32 array in [0, 1]'''
+    from PIL import Image
+    img = np.asarray(Image.open(path).convert('RGB'), dtype=np.float32) / 255.
+    return img.transpose(2, 0, 1)[None]
+
+
+def write_image(img, path):
+    from PIL import Image
+    img = (np.clip(img[0].transpose(1, 2, 0), 0, 1) * 255.).round().astype(np.uint8)
+    Image.fromarray(img).save(path)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-convert', type=str, default=None, help='*_G.pth to convert, needs torch.')
+    parser.add_argument('-half', action='store_true', help='Store converted weights as float16.')
+    parser.add_argument('-model', type=str, default=None, help='Converted .npz model.')
+    parser.add_argument('-input', type=str, default=None, help='Image file or folder.')
+    parser.add_argument('-output', type=str, required=True, help='Output .npz or folder.')
+    parser.add_argument('-mode', type=str, default='downscale', choices=['downscale', 'upscale'])
+    parser.add_argument('-gaussian_scale', type=float, default=1)
+    parser.add_argument('-seed', type=int, default=None)
+    args = parser.parse_args()
+
+    if args.convert:
+        convert(args.convert, args.output, args.half)
+        print('Saved {:s}'.format(args.output))
+        return
+
+    net = NumpyIRN(args.model)
+    if osp.isdir(args.input):
+        paths = sorted(osp.join(args.input, f) for f in os.listdir(args.input)
+                       if f.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp')))
+    else:
+        paths = [args.input]
+    os.makedirs(args.output, exist_ok=True)
+    for path in paths:
+        img = read_image(path)
+        start = time.time()
+        if args.mode == 'downscale':
+            H, W = img.shape[2] // net.scale * net.scale, img.shape[3] // net.scale * net.scale
+            out = net.downscale(img[:, :, :H, :W])
+            out = np.round(np.clip(out, 0, 1) * 255.) / 255.  # 8-bit LR, as Quantization
+        else:
+            out = net.upscale(img, gaussian_scale=args.gaussian_scale, seed=args.seed)
+        name = osp.splitext(osp.basename(path))[0] + '.png'
+        write_image(out, osp.join(args.output, name))
+        print('{:s}: {:.3f}s'.format(name, time.time() - start))
+
+
+if __name__ == '__main__':
+    main()
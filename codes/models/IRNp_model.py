@@ -1,4 +1,5 @@
 import logging
+import os
 from collections import OrderedDict
 
 import torch
@@ -9,6 +10,11 @@ import models.lr_scheduler as lr_scheduler
 from .base_model import BaseModel
 from models.modules.loss import GANLoss, ReconstructionLoss
 from models.modules.Quantization import Quantization
+from models.modules.compile_util import CompiledInvRescaleNet
+from models.modules import quant_util
+from models.modules.noise_util import LatentNoise
+from models.modules import memory_util
+import models.modules.module_util as mutil
 
 logger = logging.getLogger('base')
 
@@ -32,9 +38,37 @@ class IRNpModel(BaseModel):
             self.netG = DataParallel(self.netG)
         # print network
         self.print_network()
+        # knowledge distillation (network_T) is only implemented in IRNModel
+        if self.is_train and (opt['network_T'] or opt['path']['pretrain_model_T']):
+            raise NotImplementedError('Distillation with network_T is not supported by IRN+, '
+                                      'use model: IRN.')
+        # quantization-aware fine-tuning, fake-quant in the DenseBlock convs of a pretrained G
+        self.qat = bool(self.is_train and train_opt['qat'])
+        self.qat_backend = 'x86'
+        if self.is_train and train_opt['qat_backend']:
+            self.qat_backend = train_opt['qat_backend']
+        if self.qat:
+            assert not opt['network_G']['reversible'] and not opt['network_G']['fuse_gh'], \
+                'qat does not support reversible or fuse_gh'
         self.load()
+        if self.qat and not opt['path']['resume_state']:
+            quant_util.prepare_qat(self.netG.module, self.qat_backend)
 
         self.Quantization = Quantization()
+        # builds the reverse input [LR, z], z drawn on the device into reused buffers
+        self.noise = LatentNoise(self.device)
+        # peak activation memory estimates, test: memory_budget_MB picks tile and batch sizes
+        self.memory_budget = None
+        if self.test_opt and self.test_opt['memory_budget_MB']:
+            self.memory_budget = self.test_opt['memory_budget_MB'] * 2**20
+        self.memory_coefs = None
+        if self.test_opt and self.test_opt['memory_calibration']:
+            self.memory_coefs = memory_util.load_coefs(self.test_opt['memory_calibration'])
+
+        # compiled inference graphs, test: compile is inductor or trace
+        self.compiled_G = None
+        if self.test_opt and self.test_opt['compile']:
+            self.compiled_G = CompiledInvRescaleNet(self.netG, self.test_opt['compile'])
 
         if self.is_train:
             self.netD = networks.define_D(opt).to(self.device)
@@ -116,9 +150,6 @@ class IRNpModel(BaseModel):
         self.ref_L = data['LQ'].to(self.device)  # LQ
         self.real_H = data['GT'].to(self.device)  # GT
 
-    def gaussian_batch(self, dims):
-        return torch.randn(tuple(dims)).to(self.device)
-
     def loss_forward(self, out, y):
         l_forw_fit = self.train_opt['lambda_fit_forw'] * self.Reconstruction_forw(out[:, :3, :, :], y)
 
@@ -168,7 +199,7 @@ class IRNpModel(BaseModel):
         LR = self.Quantization(self.output[:, :3, :, :])
 
         gaussian_scale = self.train_opt['gaussian_scale'] if self.train_opt['gaussian_scale'] != None else 1
-        y_ = torch.cat((LR, gaussian_scale * self.gaussian_batch(zshape)), dim=1)
+        y_ = self.noise.with_latent(LR, zshape[1], gaussian_scale)
 
         self.fake_H = self.netG(x=y_, rev=True)
 
@@ -214,11 +245,37 @@ class IRNpModel(BaseModel):
             self.log_dict['l_back_gan'] = l_back_gan.item()
         self.log_dict['l_d'] = l_d_total.item()
 
+    def inference_G(self, x, rev=False, lr_only=False):
+        # lr_only: only the LR image of the forward pass is needed, z is not computed
+        # tiled execution bounds the activation memory by test: tile_size, or by the largest
+        # tile within test: memory_budget_MB when the whole image does not fit. The options
+        # are HR pixels, tiled_forward takes input pixels: LR ones in the reverse pass
+        scale = self.opt['scale'] if rev else 1
+        tile_size = None
+        if self.test_opt and self.test_opt['tile_size']:
+            tile_size = max(self.test_opt['tile_size'] // scale, 1)
+        tile_overlap = 32
+        if self.test_opt and self.test_opt['tile_overlap'] is not None:
+            tile_overlap = self.test_opt['tile_overlap']
+        tile_overlap //= scale
+        if not tile_size and self.memory_budget and not torch.is_grad_enabled():
+            tile_size = self.memory_model().largest_tile(x.shape, self.memory_budget, rev,
+                                                         tile_overlap)
+        if tile_size:
+            return self.netG.module.tiled_forward(x, rev=rev, tile_size=tile_size,
+                                                  tile_overlap=tile_overlap, lr_only=lr_only)
+        if self.compiled_G is not None and not torch.is_grad_enabled():
+            return self.compiled_G.downscale(x) if lr_only else self.compiled_G(x, rev=rev)
+        if lr_only:
+            return self.netG.module.downscale(x)
+        return self.netG(x=x, rev=rev, stateless=True, inplace=not torch.is_grad_enabled())
+
     def test(self):
         Lshape = self.ref_L.shape
 
         input_dim = Lshape[1]
-        self.input = self.real_H
+        # sizes that are not multiples of the scale are padded, fake_H is cropped back
+        self.input = self.pad(self.real_H)
 
         zshape = [Lshape[0], input_dim * (self.opt['scale']**2) - Lshape[1], Lshape[2], Lshape[3]]
 
@@ -228,34 +285,156 @@ class IRNpModel(BaseModel):
 
         self.netG.eval()
         with torch.no_grad():
-            self.forw_L = self.netG(x=self.input)[:, :3, :, :]
-            self.forw_L = self.Quantization(self.forw_L)
-            y_forw = torch.cat((self.forw_L, gaussian_scale * self.gaussian_batch(zshape)), dim=1)
-            self.fake_H = self.netG(x=y_forw, rev=True)[:, :3, :, :]
+            if self.test_opt and self.test_opt['self_ensemble']:
+                self.forw_L, self.fake_H = self.test_ensemble(gaussian_scale)
+            else:
+                self.forw_L = self.inference_G(self.input, lr_only=True)[:, :3, :, :]
+                self.forw_L = self.Quantization(self.forw_L)
+                y_forw = self.noise.with_latent(self.forw_L, zshape[1], gaussian_scale)
+                self.fake_H = self.inference_G(y_forw, rev=True)[:, :3, :, :]
+        self.fake_H = self.fake_H[:, :, :self.real_H.shape[2], :self.real_H.shape[3]]
 
         self.netG.train()
 
+    def pad(self, x):
+        '''Pads the bottom and right of x to multiples of the scale, test: pad_mode is
+        reflect (default) or replicate. The LR of an H x W image is
+        ceil(H / scale) x ceil(W / scale).'''
+        pad_mode = 'reflect'
+        if self.test_opt and self.test_opt['pad_mode']:
+            pad_mode = self.test_opt['pad_mode']
+        return mutil.pad_to_multiple(x, self.opt['scale'], pad_mode)
+
+    def test_ensemble(self, gaussian_scale=1):
+        '''x8 self-ensemble of test(), returns the LR and the HR image.
+
+        The flipped / transposed copies of the input are stacked into batches of
+        test: ensemble_batch copies (8 by default; the transposed copies of a non-square
+        input get their own batch), run through netG once per direction, transformed
+        back and averaged. The averaged LR is quantized before the reverse ensemble.
+        '''
+        batch = self.test_opt['ensemble_batch'] if self.test_opt['ensemble_batch'] else 8
+
+        def ensemble(x, fn):
+            N = x.shape[0]
+            groups = {}  # transforms with the same output shape can share a batch
+            for mode in range(8):
+                groups.setdefault(mode >= 4 and x.shape[2] != x.shape[3], []).append(mode)
+            out = 0
+            for modes in groups.values():
+                for i in range(0, len(modes), batch):
+                    chunk = modes[i:i + batch]
+                    y = fn(torch.cat([mutil.geometric_transform(x, mode) for mode in chunk]))
+                    for j, mode in enumerate(chunk):
+                        y_j = y[j * N:(j + 1) * N]
+                        out = out + mutil.geometric_transform(y_j, mode, inverse=True)
+            return out / 8
+
+        def upscale(LR):
+            z_channels = LR.shape[1] * (self.opt['scale']**2 - 1)
+            y_ = self.noise.with_latent(LR, z_channels, gaussian_scale)
+            return self.inference_G(y_, rev=True)[:, :3, :, :]
+
+        def downscale(x):
+            return self.inference_G(x, lr_only=True)[:, :3, :, :]
+
+        LR = self.Quantization(ensemble(self.input, downscale))
+        return LR, ensemble(LR, upscale)
+
     def downscale(self, HR_img):
+        # a list of images of mixed sizes gives a list, equally padded sizes share a batch
+        if isinstance(HR_img, (list, tuple)):
+            return mutil.run_grouped([self.pad(x if x.dim() == 4 else x[None]) for x in HR_img],
+                                     self.downscale, self.batch_limit(rev=False))
+
         self.netG.eval()
         with torch.no_grad():
-            LR_img = self.netG(x=HR_img)[:, :3, :, :]
-            LR_img = self.Quantization(self.forw_L)
+            LR_img = self.inference_G(self.pad(HR_img), lr_only=True)[:, :3, :, :]
+            LR_img = self.Quantization(LR_img)
         self.netG.train()
 
         return LR_img
 
-    def upscale(self, LR_img, scale, gaussian_scale=1):
-        Lshape = LR_img.shape
-        zshape = [Lshape[0], Lshape[1] * (scale**2 - 1), Lshape[2], Lshape[3]]
-        y_ = torch.cat((LR_img, gaussian_scale * self.gaussian_batch(zshape)), dim=1)
+    def upscale(self, LR_img, scale, gaussian_scale=1, seed=None, size=None):
+        # seed: draw z from a generator of its own, reproducible on the same device type
+        # size: (H, W) of the original HR image, crops the padding of downscale
+        if isinstance(LR_img, (list, tuple)):
+            HR_imgs = mutil.run_grouped(LR_img,
+                                        lambda x: self.upscale(x, scale, gaussian_scale, seed),
+                                        self.batch_limit(rev=True))
+            if size is not None:
+                HR_imgs = [x[:, :, :H, :W] for x, (H, W) in zip(HR_imgs, size)]
+            return HR_imgs
+
+        generator = self.noise.generator(seed) if seed is not None else None
 
         self.netG.eval()
         with torch.no_grad():
-            HR_img = self.netG(x=y_, rev=True)[:, :3, :, :]
+            z_channels = LR_img.shape[1] * (scale**2 - 1)
+            y_ = self.noise.with_latent(LR_img, z_channels, gaussian_scale, generator)
+            HR_img = self.inference_G(y_, rev=True)[:, :3, :, :]
         self.netG.train()
 
+        if size is not None:
+            HR_img = HR_img[:, :, :size[0], :size[1]]
         return HR_img
 
+    def upscale_samples(self, LR_img, scale, k, seeds=None, gaussian_scale=1, chunk=None,
+                        stats=False):
+        '''k upscalings of LR_img with independent latent draws, in batched reverse passes.
+
+        The k copies of LR_img and their z are stacked into batches of at most chunk
+        samples; by default as many as fit in test: sample_memory_MB (or memory_budget_MB),
+        all k without either.
+        seeds gives one seed per sample, sample i then does not depend on k or chunk.
+        Returns a k x N x 3 x H x W tensor, with stats=True also the per-pixel mean and
+        variance over the k samples.
+        '''
+        assert seeds is None or len(seeds) == k, 'Give one seed per sample.'
+        N = LR_img.shape[0]
+        zshape = [N, LR_img.shape[1] * (scale**2 - 1), LR_img.shape[2], LR_img.shape[3]]
+        if chunk is None:
+            chunk = k
+            budget = self.memory_budget
+            if self.test_opt and self.test_opt['sample_memory_MB']:
+                budget = self.test_opt['sample_memory_MB'] * 2**20
+            if budget:
+                per_chunk = self.memory_model().largest_batch(LR_img.shape, budget, rev=True)
+                chunk = max(1, min(k, per_chunk // N))
+
+        self.netG.eval()
+        samples = []
+        with torch.no_grad():
+            for start in range(0, k, chunk):
+                n = min(chunk, k - start)
+                generators = None
+                if seeds is not None:
+                    generators = [self.noise.generator(s) for s in seeds[start:start + n]]
+                y_ = self.noise.with_latent(LR_img.repeat(n, 1, 1, 1), zshape[1], gaussian_scale,
+                                            generators)
+                HR_img = self.inference_G(y_, rev=True)[:, :3, :, :]
+                samples.append(HR_img.view(n, N, *HR_img.shape[1:]))
+        self.netG.train()
+
+        samples = torch.cat(samples, 0)
+        if stats:
+            var, mean = torch.var_mean(samples, dim=0, unbiased=False)
+            return samples, mean, var
+        return samples
+
+    def memory_model(self):
+        '''Peak activation memory model of netG as it is now (loaded, pruned), with the
+        coefficients of test: memory_calibration (scripts/calibrate_memory.py) if given'''
+        return memory_util.MemoryModel.from_net(self.netG.module, self.memory_coefs)
+
+    def batch_limit(self, rev):
+        '''Largest batch within test: memory_budget_MB as a function of the image size,
+        for run_grouped'''
+        if not self.memory_budget:
+            return None
+        memory = self.memory_model()
+        return lambda shape: memory.largest_batch((1, ) + shape, self.memory_budget, rev)
+
     def get_current_log(self):
         return self.log_dict
 
@@ -281,6 +460,9 @@ class IRNpModel(BaseModel):
     def load(self):
         load_path_G = self.opt['path']['pretrain_model_G']
         if load_path_G is not None:
+            if self.qat and self.opt['path']['resume_state']:
+                # checkpoints of a QAT run hold the fake-quant modules and their state
+                quant_util.prepare_qat(self.netG.module, self.qat_backend)
             logger.info('Loading model for G [{:s}] ...'.format(load_path_G))
             self.load_network(load_path_G, self.netG, self.opt['path']['strict_load'])
 
@@ -292,3 +474,11 @@ class IRNpModel(BaseModel):
     def save(self, iter_label):
         self.save_network(self.netG, 'G', iter_label)
         self.save_network(self.netD, 'D', iter_label)
+        if self.qat:
+            self.save_quantized(iter_label)
+
+    def save_quantized(self, iter_label):
+        '''Convert a copy of the QAT netG to int8 DenseBlocks and save it as {iter}_G_int8.pth'''
+        net = quant_util.export_int8(self.netG.module)
+        save_path = os.path.join(self.opt['path']['models'], '{}_G_int8.pth'.format(iter_label))
+        torch.save(net.state_dict(), save_path)
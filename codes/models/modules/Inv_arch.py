@@ -3,48 +3,171 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import numpy as np
+from models.modules.Subnet_constructor import FusedDenseBlock, Bf16FusedDenseBlock, AutocastMixin
 
 
 class InvBlockExp(nn.Module):
-    def __init__(self, subnet_constructor, channel_num, channel_split_num, clamp=1.):
+    def __init__(self, subnet_constructor, channel_num, channel_split_num, clamp=1., fuse_gh=False):
         super(InvBlockExp, self).__init__()
 
         self.split_len1 = channel_split_num
         self.split_len2 = channel_num - channel_split_num
 
         self.clamp = clamp
+        self.fuse_gh = fuse_gh
 
         self.F = subnet_constructor(self.split_len2, self.split_len1)
-        self.G = subnet_constructor(self.split_len1, self.split_len2)
-        self.H = subnet_constructor(self.split_len1, self.split_len2)
+        G = subnet_constructor(self.split_len1, self.split_len2)
+        H = subnet_constructor(self.split_len1, self.split_len2)
+        if fuse_gh:
+            # G and H read the same tensor, evaluate them in one FusedDenseBlock
+            fused = Bf16FusedDenseBlock if isinstance(G, AutocastMixin) else FusedDenseBlock
+            self.GH = fused.from_dense_blocks(G, H)
+        else:
+            self.G = G
+            self.H = H
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints of unfused models store G and H separately
+        if self.fuse_gh and prefix + 'G.conv1.weight' in state_dict:
+            sd_G, sd_H = {}, {}
+            for k in list(state_dict.keys()):
+                if k.startswith(prefix + 'G.'):
+                    sd_G[k[len(prefix) + 2:]] = state_dict.pop(k)
+                elif k.startswith(prefix + 'H.'):
+                    sd_H[k[len(prefix) + 2:]] = state_dict.pop(k)
+            for k, v in FusedDenseBlock.fuse_state_dict(sd_G, sd_H, self.split_len1).items():
+                state_dict[prefix + 'GH.' + k] = v
+        super(InvBlockExp, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def _GH(self, x):
+        if self.fuse_gh:
+            return self.GH(x)
+        return self.G(x), self.H(x)
 
     def forward(self, x, rev=False):
+        out, self.s = self.coupling(x, rev)
+        return out
+
+    def coupling(self, x, rev=False):
         x1, x2 = (x.narrow(1, 0, self.split_len1), x.narrow(1, self.split_len1, self.split_len2))
 
         if not rev:
             y1 = x1 + self.F(x2)
-            self.s = self.clamp * (torch.sigmoid(self.H(y1)) * 2 - 1)
-            y2 = x2.mul(torch.exp(self.s)) + self.G(y1)
+            g, h = self._GH(y1)
+            s = self.clamp * (torch.sigmoid(h) * 2 - 1)
+            y2 = x2.mul(torch.exp(s)) + g
         else:
-            self.s = self.clamp * (torch.sigmoid(self.H(x1)) * 2 - 1)
-            y2 = (x2 - self.G(x1)).div(torch.exp(self.s))
+            g, h = self._GH(x1)
+            s = self.clamp * (torch.sigmoid(h) * 2 - 1)
+            y2 = (x2 - g).div(torch.exp(s))
             y1 = x1 - self.F(y2)
 
-        return torch.cat((y1, y2), 1)
+        return torch.cat((y1, y2), 1), s
+
+    def inplace_forward(self, x, rev=False):
+        '''Inference-only coupling that updates the two halves of x in place and returns x.
+        Avoids the copies of narrow/cat, call it under torch.no_grad().'''
+        x1, x2 = (x.narrow(1, 0, self.split_len1), x.narrow(1, self.split_len1, self.split_len2))
+
+        if not rev:
+            x1.add_(self.F(x2))
+            g, h = self._GH(x1)
+            x2.mul_(h.sigmoid_().mul_(2).sub_(1).mul_(self.clamp).exp_()).add_(g)
+        else:
+            g, h = self._GH(x1)
+            x2.sub_(g).div_(h.sigmoid_().mul_(2).sub_(1).mul_(self.clamp).exp_())
+            x1.sub_(self.F(x2))
+
+        return x
+
+    def forward_y1(self, x):
+        '''First split_len1 channels of the forward output. G, H and exp(s) only feed y2
+        and are skipped.'''
+        x1, x2 = (x.narrow(1, 0, self.split_len1), x.narrow(1, self.split_len1, self.split_len2))
+        return x1 + self.F(x2)
 
     def jacobian(self, x, rev=False):
+        return self._jacobian(self.s, x, rev)
+
+    def stateless_forward(self, x, rev=False):
+        '''Same as forward followed by jacobian, but nothing is stored on the module'''
+        out, s = self.coupling(x, rev)
+        return out, self._jacobian(s, out, rev)
+
+    def _jacobian(self, s, x, rev):
         if not rev:
-            jac = torch.sum(self.s)
+            jac = torch.sum(s)
         else:
-            jac = -torch.sum(self.s)
+            jac = -torch.sum(s)
 
         return jac / x.shape[0]
 
 
+def _trainable_weights(blocks):
+    '''The weight tensors the blocks run with that need gradients. On a DataParallel
+    replica parameters() is empty, the broadcast copies are plain attributes that are
+    also kept in _former_parameters.'''
+    weights = []
+    for block in blocks:
+        for m in block.modules():
+            params = m._former_parameters if hasattr(m, '_former_parameters') else m._parameters
+            weights += [p for p in params.values() if p is not None and p.requires_grad]
+    return weights
+
+
+class ReversibleFunction(torch.autograd.Function):
+    '''Run a chain of InvBlockExp without keeping their activations.
+
+    Only the output of the chain is saved. During the backward pass the input of
+    each block is rebuilt from its output with the inverse pass, then the block is
+    run again with autograd enabled to backpropagate through it (RevNet style).
+    The blocks run through coupling(), so nothing is stored on the modules, and only
+    the input and output of the current block and the weight gradients stay alive.
+    blocks are given in the order they are applied.
+    '''
+
+    @staticmethod
+    def forward(ctx, x, rev, blocks, *params):
+        ctx.rev = rev
+        ctx.blocks = blocks
+        ctx.params = params
+        out = x
+        for block in blocks:
+            out = block.coupling(out, rev)[0]
+        ctx.save_for_backward(out)
+        return out
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        y, = ctx.saved_tensors
+        grads = {}
+        for block in reversed(ctx.blocks):
+            with torch.no_grad():
+                x = block.coupling(y, not ctx.rev)[0]
+            with torch.enable_grad():
+                x.requires_grad_()
+                block_params = _trainable_weights([block])
+                y_re = block.coupling(x, ctx.rev)[0]
+                block_grads = torch.autograd.grad(y_re, [x] + block_params, grad_output)
+            del y_re
+            grad_output = block_grads[0]
+            # every weight belongs to one block, its gradient is complete here
+            grads.update(zip(map(id, block_params), block_grads[1:]))
+            y = x.detach()
+
+        return (grad_output, None, None) + tuple(grads.get(id(p)) for p in ctx.params)
+
+
+# signs of the 2nd, 3rd and 4th taps of the haar_weights, per sub-band
+_HAAR_SIGNS = ((1, 1, 1), (-1, 1, -1), (1, -1, -1), (-1, -1, 1))
+
+
 class HaarDownsampling(nn.Module):
-    def __init__(self, channel_in):
+    def __init__(self, channel_in, use_conv=False):
         super(HaarDownsampling, self).__init__()
         self.channel_in = channel_in
+        self.use_conv = use_conv
 
         self.haar_weights = torch.ones(4, 1, 2, 2)
 
@@ -62,9 +185,25 @@ class HaarDownsampling(nn.Module):
         self.haar_weights.requires_grad = False
 
     def forward(self, x, rev=False):
+        self.elements = x.shape[1] * x.shape[2] * x.shape[3]
+        self.last_jac = self._jacobian(x, rev)
+        return self.transform(x, rev)
+
+    def stateless_forward(self, x, rev=False):
+        '''Same as forward followed by jacobian, but nothing is stored on the module'''
+        return self.transform(x, rev), self._jacobian(x, rev)
+
+    def _jacobian(self, x, rev):
+        elements = x.shape[1] * x.shape[2] * x.shape[3]
         if not rev:
-            self.elements = x.shape[1] * x.shape[2] * x.shape[3]
-            self.last_jac = self.elements / 4 * np.log(1/16.)
+            return elements / 4 * np.log(1 / 16.)
+        else:
+            return elements / 4 * np.log(16.)
+
+    def transform(self, x, rev=False):
+        if not rev:
+            if not self.use_conv:
+                return self.haar_forward(x)
 
             out = F.conv2d(x, self.haar_weights, bias=None, stride=2, groups=self.channel_in) / 4.0
             out = out.reshape([x.shape[0], self.channel_in, 4, x.shape[2] // 2, x.shape[3] // 2])
@@ -72,36 +211,94 @@ class HaarDownsampling(nn.Module):
             out = out.reshape([x.shape[0], self.channel_in * 4, x.shape[2] // 2, x.shape[3] // 2])
             return out
         else:
-            self.elements = x.shape[1] * x.shape[2] * x.shape[3]
-            self.last_jac = self.elements / 4 * np.log(16.)
+            if not self.use_conv:
+                return self.haar_reverse(x)
 
             out = x.reshape([x.shape[0], 4, self.channel_in, x.shape[2], x.shape[3]])
             out = torch.transpose(out, 1, 2)
             out = out.reshape([x.shape[0], self.channel_in * 4, x.shape[2], x.shape[3]])
             return F.conv_transpose2d(out, self.haar_weights, bias=None, stride=2, groups = self.channel_in)
 
+    def haar_forward(self, x):
+        # pixel-unshuffle by strided views, then the 4x4 butterfly of the haar_weights.
+        # The sums run in the same order as in the convolution, so the output is bit-identical.
+        # A channels_last input gives a channels_last output, written in place
+        N, C, H, W = x.shape
+        channels_last = _is_channels_last(x)
+        shape = (N, C, H // 2, 2, W // 2, 2)
+        x = x.view(shape) if channels_last else x.reshape(shape)
+        a, b = x[:, :, :, 0, :, 0], x[:, :, :, 0, :, 1]
+        c, d = x[:, :, :, 1, :, 0], x[:, :, :, 1, :, 1]
+        if channels_last:
+            buf = x.new_empty(N, H // 2, W // 2, 4, C)
+            out = buf.permute(0, 3, 4, 1, 2)
+        else:
+            out = x.new_empty(N, 4, C, H // 2, W // 2)
+        for k, (sb, sc, sd) in enumerate(_HAAR_SIGNS):
+            out[:, k].copy_(a).add_(b, alpha=sb).add_(c, alpha=sc).add_(d, alpha=sd)
+        if channels_last:
+            return buf.view(N, H // 2, W // 2, 4 * C).permute(0, 3, 1, 2).div_(4.0)
+        return out.reshape(N, 4 * C, H // 2, W // 2).div_(4.0)
+
+    def haar_reverse(self, x):
+        N, C, H, W = x.shape
+        channels_last = _is_channels_last(x)
+        x = x.view(N, 4, C // 4, H, W) if channels_last else x.reshape(N, 4, C // 4, H, W)
+        ll, lh, hl, hh = x[:, 0], x[:, 1], x[:, 2], x[:, 3]
+        if channels_last:
+            buf = x.new_empty(N, H, 2, W, 2, C // 4)
+            out = buf.permute(0, 5, 1, 2, 3, 4)
+        else:
+            out = x.new_empty(N, C // 4, H, 2, W, 2)
+        for k, signs in enumerate(_HAAR_SIGNS):
+            out[:, :, :, k // 2, :, k % 2].copy_(ll).add_(lh, alpha=signs[0]).add_(
+                hl, alpha=signs[1]).add_(hh, alpha=signs[2])
+        if channels_last:
+            return buf.view(N, H * 2, W * 2, C // 4).permute(0, 3, 1, 2)
+        return out.reshape(N, C // 4, H * 2, W * 2)
+
     def jacobian(self, x, rev=False):
         return self.last_jac
 
 
 class InvRescaleNet(nn.Module):
-    def __init__(self, channel_in=3, channel_out=3, subnet_constructor=None, block_num=[], down_num=2):
+    def __init__(self, channel_in=3, channel_out=3, subnet_constructor=None, block_num=[],
+                 down_num=2, reversible=False, haar_conv=False, fuse_gh=False, channels_last=False):
         super(InvRescaleNet, self).__init__()
 
         operations = []
 
         current_channel = channel_in
         for i in range(down_num):
-            b = HaarDownsampling(current_channel)
+            b = HaarDownsampling(current_channel, haar_conv)
             operations.append(b)
             current_channel *= 4
             for j in range(block_num[i]):
-                b = InvBlockExp(subnet_constructor, current_channel, channel_out)
+                b = InvBlockExp(subnet_constructor, current_channel, channel_out, fuse_gh=fuse_gh)
                 operations.append(b)
 
         self.operations = nn.ModuleList(operations)
+        self.channel_out = channel_out
+        self.down_num = down_num
+        self.reversible = reversible
+        # NHWC activations end to end, inputs are converted once on entry
+        self.channels_last = channels_last
+        if channels_last:
+            self.to(memory_format=torch.channels_last)
+
+    def forward(self, x, rev=False, cal_jacobian=False, stateless=False, inplace=False):
+        '''With stateless=True the log-determinant terms are returned instead of being
+        stored on the modules, so one instance can serve several threads at once.
+        inplace=True selects the low-allocation inference path, see inplace_forward.'''
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
+        if inplace and not cal_jacobian:
+            return self.inplace_forward(x, rev)
+        if stateless:
+            return self.stateless_forward(x, rev, cal_jacobian)
+        if self.reversible and torch.is_grad_enabled() and not cal_jacobian:
+            return self.reversible_forward(x, rev)
 
-    def forward(self, x, rev=False, cal_jacobian=False):
         out = x
         jacobian = 0
 
@@ -121,3 +318,173 @@ class InvRescaleNet(nn.Module):
         else:
             return out
 
+    def stateless_forward(self, x, rev=False, cal_jacobian=False):
+        ops = self.operations if not rev else reversed(self.operations)
+        out = x
+        jacobian = 0
+        for op in ops:
+            out, jac = op.stateless_forward(out, rev)
+            jacobian += jac
+
+        if cal_jacobian:
+            return out, jacobian
+        else:
+            return out
+
+    def inplace_forward(self, x, rev=False):
+        '''Inference-only pass that keeps one activation buffer for consecutive InvBlockExp
+        and updates its halves in place, instead of allocating y1, y2 and their cat in
+        every block. x itself is not modified. Stateless, call it under torch.no_grad().
+        '''
+        assert not torch.is_grad_enabled(), 'inplace_forward is only for inference.'
+        ops = self.operations if not rev else reversed(self.operations)
+        return self._inplace_ops(x, ops, rev)
+
+    def _inplace_ops(self, x, ops, rev):
+        out = x
+        owned = False  # whether out is a buffer of our own, safe to write into
+        for op in ops:
+            if isinstance(op, InvBlockExp):
+                if not owned:
+                    out = out.clone()
+                    owned = True
+                out = op.inplace_forward(out, rev)
+            else:
+                out = op.transform(out, rev)
+                owned = True
+
+        return out
+
+    def downscale(self, x, channels=None, inplace=None):
+        '''Forward pass that only computes the first channels outputs, the LR image by default.
+
+        Walks back from the output to find the work that only feeds the discarded z
+        channels: when the last op is an InvBlockExp whose y1 covers the kept channels,
+        its G and H subnets and exp(s) are skipped. Gives the same result as
+        forward(x)[:, :channels]. inplace defaults to the in-place path whenever grad
+        is disabled.
+        '''
+        if channels is None:
+            channels = self.channel_out
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
+        ops = list(self.operations)
+        last = ops[-1]
+        y1_only = isinstance(last, InvBlockExp) and channels <= last.split_len1
+        if y1_only:
+            ops = ops[:-1]
+
+        if inplace is None:
+            inplace = not torch.is_grad_enabled()
+        if inplace:
+            out = self._inplace_ops(x, ops, False)
+        else:
+            out = x
+            for op in ops:
+                out, _ = op.stateless_forward(out)
+        if y1_only:
+            out = last.forward_y1(out)
+
+        return out[:, :channels]
+
+    def reversible_forward(self, x, rev=False):
+        '''Forward (or reverse) pass whose activation memory does not grow with block_num.
+
+        Runs of consecutive InvBlockExp are executed through ReversibleFunction, the
+        HaarDownsampling layers in between keep their usual autograd graph.
+        '''
+        ops = self.operations if not rev else reversed(self.operations)
+        out = x
+        blocks = []
+        for op in ops:
+            if isinstance(op, InvBlockExp):
+                blocks.append(op)
+                continue
+            if blocks:
+                out = self._run_reversible(out, rev, blocks)
+                blocks = []
+            out = op.forward(out, rev)
+        if blocks:
+            out = self._run_reversible(out, rev, blocks)
+
+        return out
+
+    def _run_reversible(self, x, rev, blocks):
+        return ReversibleFunction.apply(x, rev, blocks, *_trainable_weights(blocks))
+
+    def tiled_forward(self, x, rev=False, tile_size=512, tile_overlap=32, lr_only=False):
+        '''Run the forward (or reverse) pass tile by tile and blend the seams.
+
+        tile_size and tile_overlap are given in input pixels. Tiles are cut on the
+        2**down_num grid of the HR image, so every tile is a valid Haar input, and
+        overlapping outputs are blended with linear ramps. Peak activation memory is
+        bounded by the tile size; only the input and the output are full size.
+
+        The result is not bit-exact: the receptive field of the DenseBlocks is cut at
+        the tile borders, so the output deviates from whole-image inference in bands
+        around the seams, and the deviation decays as the overlap grows.
+        scripts/check_tiled.py measures it for a checkpoint and fails below 40 dB PSNR
+        (image channels) against whole-image inference, which is the tolerance we keep.
+        With lr_only=True each tile runs through downscale and only the LR image is kept.
+        Intended for inference, call it under torch.no_grad().
+        '''
+        scale = 2**self.down_num
+        in_f, out_f = (scale, 1) if not rev else (1, scale)
+        N, C, H, W = x.shape
+        assert H % in_f == 0 and W % in_f == 0, 'Input size must be a multiple of {}.'.format(in_f)
+
+        # tile geometry on the LR grid
+        H_l, W_l = H // in_f, W // in_f
+        tile = max(tile_size // in_f, 1)
+        overlap = tile_overlap // in_f
+        if overlap >= tile:
+            raise ValueError('tile_overlap must be smaller than tile_size.')
+
+        out = None
+        weight = x.new_zeros(1, 1, H_l * out_f, W_l * out_f)
+        for h in _tile_starts(H_l, tile, overlap):
+            for w in _tile_starts(W_l, tile, overlap):
+                h_end, w_end = min(h + tile, H_l), min(w + tile, W_l)
+                x_tile = x[:, :, h * in_f:h_end * in_f, w * in_f:w_end * in_f]
+                if lr_only:
+                    out_tile = self.downscale(x_tile)
+                else:
+                    out_tile = self.forward(x_tile, rev=rev, stateless=True,
+                                            inplace=not torch.is_grad_enabled())
+                if out is None:
+                    out = x.new_zeros(N, out_tile.shape[1], H_l * out_f, W_l * out_f)
+
+                w_h = _blend_ramp(h, h_end, H_l, overlap, out_f, x)
+                w_w = _blend_ramp(w, w_end, W_l, overlap, out_f, x)
+                w_tile = w_h.view(1, 1, -1, 1) * w_w.view(1, 1, 1, -1)
+                out[:, :, h * out_f:h_end * out_f, w * out_f:w_end * out_f] += out_tile * w_tile
+                weight[:, :, h * out_f:h_end * out_f, w * out_f:w_end * out_f] += w_tile
+
+        return out / weight
+
+
+def _is_channels_last(x):
+    # NHWC storage; size-1 dims make both layouts match, those count as NCHW
+    return not x.is_contiguous() and x.is_contiguous(memory_format=torch.channels_last)
+
+
+def _tile_starts(length, tile, overlap):
+    if length <= tile:
+        return [0]
+    stride = tile - overlap
+    starts = list(range(0, length - tile, stride))
+    starts.append(length - tile)
+    return starts
+
+
+def _blend_ramp(start, end, length, overlap, factor, ref):
+    '''1-D blending weights of one tile, ramping up on sides shared with a neighbour'''
+    w = ref.new_ones((end - start) * factor)
+    n = overlap * factor
+    if n > 0:
+        ramp = (torch.arange(n, dtype=w.dtype, device=w.device) + 0.5) / n
+        if start > 0:
+            w[:n] = ramp
+        if end < length:
+            w[-n:] = ramp.flip(0)
+    return w
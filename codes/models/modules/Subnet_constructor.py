@@ -1,16 +1,23 @@
+import functools
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 import models.modules.module_util as mutil
 
+
+def growth_widths(gc):
+    # gc is the width of x1 to x4, or the list of their four widths in a pruned block
+    return list(gc) if isinstance(gc, (list, tuple)) else [gc] * 4
+
+
 class DenseBlock(nn.Module):
     def __init__(self, channel_in, channel_out, init='xavier', gc=32, bias=True):
         super(DenseBlock, self).__init__()
-        self.conv1 = nn.Conv2d(channel_in, gc, 3, 1, 1, bias=bias)
-        self.conv2 = nn.Conv2d(channel_in + gc, gc, 3, 1, 1, bias=bias)
-        self.conv3 = nn.Conv2d(channel_in + 2 * gc, gc, 3, 1, 1, bias=bias)
-        self.conv4 = nn.Conv2d(channel_in + 3 * gc, gc, 3, 1, 1, bias=bias)
-        self.conv5 = nn.Conv2d(channel_in + 4 * gc, channel_out, 3, 1, 1, bias=bias)
+        self._build_convs(channel_in, channel_out, growth_widths(gc), bias)
+        # the widths of the options, a pruned checkpoint may only narrow them
+        self.configured_widths = growth_widths(gc)
         self.lrelu = nn.LeakyReLU(negative_slope=0.2, inplace=True)
 
         if init == 'xavier':
@@ -28,14 +35,301 @@ class DenseBlock(nn.Module):
 
         return x5
 
+    def _build_convs(self, channel_in, channel_out, widths, bias=True):
+        g1, g2, g3, g4 = widths
+        self.conv1 = nn.Conv2d(channel_in, g1, 3, 1, 1, bias=bias)
+        self.conv2 = nn.Conv2d(channel_in + g1, g2, 3, 1, 1, bias=bias)
+        self.conv3 = nn.Conv2d(channel_in + g1 + g2, g3, 3, 1, 1, bias=bias)
+        self.conv4 = nn.Conv2d(channel_in + g1 + g2 + g3, g4, 3, 1, 1, bias=bias)
+        self.conv5 = nn.Conv2d(channel_in + g1 + g2 + g3 + g4, channel_out, 3, 1, 1, bias=bias)
+
+    @property
+    def widths(self):
+        return [conv.out_channels for conv in (self.conv1, self.conv2, self.conv3, self.conv4)]
+
+    def resize(self, widths):
+        '''Rebuild conv1 to conv5 for other growth widths, the weights are not kept'''
+        weight = self.conv1.weight
+        self._build_convs(self.conv1.in_channels, self.conv5.out_channels, widths,
+                          self.conv1.bias is not None)
+        self.to(weight.device, weight.dtype, memory_format=_memory_format(weight))
+
+    def checkpoint_widths(self, state_dict, prefix):
+        '''Widths to load state_dict with: the pruned widths a pruned block saves under
+        prefix + 'pruned_widths' (see prune_util), the configured widths otherwise. Pruned
+        widths wider than the configured ones are an error, any other mismatch of the conv
+        shapes fails in load_state_dict as usual.'''
+        key = prefix + 'pruned_widths'
+        if key not in state_dict:
+            return self.configured_widths
+        widths = [int(w) for w in state_dict[key]]
+        if len(widths) != 4 or any(w > c for w, c in zip(widths, self.configured_widths)):
+            raise RuntimeError('{:s} {} is not a pruning of the configured growth widths {}.'
+                               .format(key, widths, self.configured_widths))
+        return widths
+
+    def _save_to_state_dict(self, destination, prefix, keep_vars):
+        super(DenseBlock, self)._save_to_state_dict(destination, prefix, keep_vars)
+        if self.widths != self.configured_widths:
+            destination[prefix + 'pruned_widths'] = torch.tensor(self.widths)
+
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict, missing_keys,
+                              unexpected_keys, error_msgs):
+        # pruned checkpoints have narrower convs, take over their widths
+        widths = self.checkpoint_widths(state_dict, prefix)
+        if widths != self.widths:
+            self.resize(widths)
+        super(DenseBlock, self)._load_from_state_dict(state_dict, prefix, local_metadata, strict,
+                                                      missing_keys, unexpected_keys, error_msgs)
+        if prefix + 'pruned_widths' in unexpected_keys:
+            unexpected_keys.remove(prefix + 'pruned_widths')
+
+
+class MemoryEfficientDenseBlock(DenseBlock):
+    '''DenseBlock without the growing torch.cat copies, same parameters and output.
+
+    In inference every conv writes its gc output channels into a slice of one
+    preallocated buffer [x, x1, x2, x3, x4] and the next conv reads a prefix of it
+    (a contiguous view for batch size 1). With autograd enabled the slices of a
+    shared buffer cannot be written, so the concatenation and the conv are
+    checkpointed instead: the concatenated inputs are rebuilt in backward rather
+    than kept alive.
+    '''
+    def forward(self, x):
+        if torch.is_grad_enabled():
+            return self._forward_checkpointed(x)
+
+        convs = [self.conv1, self.conv2, self.conv3, self.conv4]
+        c = x.shape[1]
+        N, _, H, W = x.shape
+        buf = torch.empty(N, c + sum(conv.out_channels for conv in convs), H, W, dtype=x.dtype,
+                          device=x.device, memory_format=_memory_format(x))
+        buf[:, :c] = x
+        for conv in convs:
+            buf[:, c:c + conv.out_channels] = self.lrelu(conv(buf[:, :c]))
+            c += conv.out_channels
+
+        return self.conv5(buf)
+
+    def _forward_checkpointed(self, x):
+        feats = [x]
+        for conv in [self.conv1, self.conv2, self.conv3, self.conv4]:
+            feats.append(checkpoint(self._cat_conv, conv, *feats, use_reentrant=False))
+        return self._cat_conv(self.conv5, *feats, act=False)
+
+    def _cat_conv(self, conv, *feats, act=True):
+        out = conv(torch.cat(feats, 1) if len(feats) > 1 else feats[0])
+        return self.lrelu(out) if act else out
+
+
+def _memory_format(x):
+    # x may be a channel slice of a larger NHWC tensor, so look at the strides only
+    if x.shape[1] > 1 and x.stride(1) == 1:
+        return torch.channels_last
+    return torch.contiguous_format
+
+
+class FusedDenseBlock(nn.Module):
+    '''The G and H DenseBlocks of an InvBlockExp, evaluated together.
+
+    Every conv of a DenseBlock reads the block input x, so the x part of all ten convs
+    of G and H is computed by one conv_x. The parts reading the growth features run
+    as grouped convs (groups=2, G first). This is an exact reparametrization of two
+    DenseBlocks; use from_dense_blocks or fuse_state_dict to convert trained weights.
+    '''
+    def __init__(self, channel_in, channel_out, gc=32, bias=True):
+        super(FusedDenseBlock, self).__init__()
+        self.channel_out = channel_out
+        self.gc = gc
+        self.conv_x = nn.Conv2d(channel_in, 2 * (4 * gc + channel_out), 3, 1, 1, bias=bias)
+        self.conv2 = nn.Conv2d(2 * gc, 2 * gc, 3, 1, 1, groups=2, bias=False)
+        self.conv3 = nn.Conv2d(2 * 2 * gc, 2 * gc, 3, 1, 1, groups=2, bias=False)
+        self.conv4 = nn.Conv2d(2 * 3 * gc, 2 * gc, 3, 1, 1, groups=2, bias=False)
+        self.conv5 = nn.Conv2d(2 * 4 * gc, 2 * channel_out, 3, 1, 1, groups=2, bias=False)
+        self.lrelu = nn.LeakyReLU(negative_slope=0.2, inplace=True)
+
+    def forward(self, x):
+        gc = self.gc
+        t = self.conv_x(x)
+        x1 = self.lrelu(t[:, :2 * gc])
+        x2 = self.lrelu(t[:, 2 * gc:4 * gc] + self.conv2(x1))
+        x3 = self.lrelu(t[:, 4 * gc:6 * gc] + self.conv3(self._stack((x1, x2))))
+        x4 = self.lrelu(t[:, 6 * gc:8 * gc] + self.conv4(self._stack((x1, x2, x3))))
+        x5 = t[:, 8 * gc:] + self.conv5(self._stack((x1, x2, x3, x4)))
+
+        return x5[:, :self.channel_out], x5[:, self.channel_out:]
+
+    def _stack(self, feats):
+        # [G1 H1], [G2 H2], ... -> [G1 G2 ... H1 H2 ...], the input layout of the grouped convs
+        N, _, H, W = feats[0].shape
+        out = torch.cat([f.view(N, 2, -1, H, W) for f in feats], 2)
+        return out.view(N, -1, H, W)
+
+    @staticmethod
+    def fuse_state_dict(sd_G, sd_H, channel_in):
+        '''Convert the state_dicts of the G and H DenseBlocks to a FusedDenseBlock one'''
+        widths = {sd['conv{}.weight'.format(i)].shape[0]
+                  for sd in (sd_G, sd_H) for i in range(1, 5)}
+        if len(widths) > 1:
+            raise NotImplementedError('fuse_gh needs equal growth widths, '
+                                      'pruned blocks are not supported.')
+        weights_x, biases_x = [], []
+        sd = {}
+        for i in range(1, 6):
+            w_G, w_H = sd_G['conv{}.weight'.format(i)], sd_H['conv{}.weight'.format(i)]
+            weights_x += [w_G[:, :channel_in], w_H[:, :channel_in]]
+            if 'conv{}.bias'.format(i) in sd_G:
+                biases_x += [sd_G['conv{}.bias'.format(i)], sd_H['conv{}.bias'.format(i)]]
+            if i > 1:
+                w = (w_G[:, channel_in:], w_H[:, channel_in:])
+                sd['conv{}.weight'.format(i)] = torch.cat(w, 0)
+        sd['conv_x.weight'] = torch.cat(weights_x, 0)
+        if biases_x:
+            sd['conv_x.bias'] = torch.cat(biases_x, 0)
+        return sd
+
+    @classmethod
+    def from_dense_blocks(cls, G, H):
+        channel_in = G.conv1.in_channels
+        block = cls(channel_in, G.conv5.out_channels, G.conv1.out_channels,
+                    G.conv1.bias is not None)
+        block.load_state_dict(cls.fuse_state_dict(G.state_dict(), H.state_dict(), channel_in))
+        return block
+
+
+def _separable_conv(channel_in, channel_out, bias=True):
+    # depthwise 3x3 followed by pointwise 1x1
+    return nn.Sequential(nn.Conv2d(channel_in, channel_in, 3, 1, 1, groups=channel_in, bias=bias),
+                         nn.Conv2d(channel_in, channel_out, 1, 1, 0, bias=bias))
+
+
+class DepthwiseSeparableDenseBlock(nn.Module):
+    '''DenseBlock with every 3x3 conv factored into a depthwise and a pointwise conv'''
+    def __init__(self, channel_in, channel_out, init='xavier', gc=32, bias=True):
+        super(DepthwiseSeparableDenseBlock, self).__init__()
+        self.conv1 = _separable_conv(channel_in, gc, bias)
+        self.conv2 = _separable_conv(channel_in + gc, gc, bias)
+        self.conv3 = _separable_conv(channel_in + 2 * gc, gc, bias)
+        self.conv4 = _separable_conv(channel_in + 3 * gc, gc, bias)
+        self.conv5 = _separable_conv(channel_in + 4 * gc, channel_out, bias)
+        self.lrelu = nn.LeakyReLU(negative_slope=0.2, inplace=True)
+
+        if init == 'xavier':
+            mutil.initialize_weights_xavier([self.conv1, self.conv2, self.conv3, self.conv4,
+                                             self.conv5[0]], 0.1)
+        else:
+            mutil.initialize_weights([self.conv1, self.conv2, self.conv3, self.conv4,
+                                      self.conv5[0]], 0.1)
+        # only the pointwise part starts at 0, a zero depthwise conv would get no gradient
+        mutil.initialize_weights(self.conv5[1], 0)
+
+    def forward(self, x):
+        x1 = self.lrelu(self.conv1(x))
+        x2 = self.lrelu(self.conv2(torch.cat((x, x1), 1)))
+        x3 = self.lrelu(self.conv3(torch.cat((x, x1, x2), 1)))
+        x4 = self.lrelu(self.conv4(torch.cat((x, x1, x2, x3), 1)))
+        x5 = self.conv5(torch.cat((x, x1, x2, x3, x4), 1))
+
+        return x5
+
+
+class GroupedDenseBlock(nn.Module):
+    '''Dense block whose inner 3x3 convs are grouped.
+
+    conv1 maps the input to gc features; conv2 to conv4 see only the growth features,
+    in groups, and conv5 is a 1x1 conv over the input and all features.
+    '''
+    def __init__(self, channel_in, channel_out, init='xavier', gc=32, groups=4, bias=True):
+        super(GroupedDenseBlock, self).__init__()
+        self.conv1 = nn.Conv2d(channel_in, gc, 3, 1, 1, bias=bias)
+        self.conv2 = nn.Conv2d(gc, gc, 3, 1, 1, groups=groups, bias=bias)
+        self.conv3 = nn.Conv2d(2 * gc, gc, 3, 1, 1, groups=groups, bias=bias)
+        self.conv4 = nn.Conv2d(3 * gc, gc, 3, 1, 1, groups=groups, bias=bias)
+        self.conv5 = nn.Conv2d(channel_in + 4 * gc, channel_out, 1, 1, 0, bias=bias)
+        self.lrelu = nn.LeakyReLU(negative_slope=0.2, inplace=True)
+
+        if init == 'xavier':
+            mutil.initialize_weights_xavier([self.conv1, self.conv2, self.conv3, self.conv4], 0.1)
+        else:
+            mutil.initialize_weights([self.conv1, self.conv2, self.conv3, self.conv4], 0.1)
+        mutil.initialize_weights(self.conv5, 0)
+
+    def forward(self, x):
+        x1 = self.lrelu(self.conv1(x))
+        x2 = self.lrelu(self.conv2(x1))
+        x3 = self.lrelu(self.conv3(torch.cat((x1, x2), 1)))
+        x4 = self.lrelu(self.conv4(torch.cat((x1, x2, x3), 1)))
+        x5 = self.conv5(torch.cat((x, x1, x2, x3, x4), 1))
+
+        return x5
 
-def subnet(net_structure, init='xavier'):
+
+class ResidualSubnet(nn.Module):
+    '''conv - nb x ResidualBlock_noBN - conv, with gc features'''
+    def __init__(self, channel_in, channel_out, init='xavier', gc=32, nb=2, bias=True):
+        super(ResidualSubnet, self).__init__()
+        self.conv_first = nn.Conv2d(channel_in, gc, 3, 1, 1, bias=bias)
+        self.body = mutil.make_layer(functools.partial(mutil.ResidualBlock_noBN, nf=gc), nb)
+        self.conv_last = nn.Conv2d(gc, channel_out, 3, 1, 1, bias=bias)
+        self.lrelu = nn.LeakyReLU(negative_slope=0.2, inplace=True)
+
+        if init == 'xavier':
+            mutil.initialize_weights_xavier(self.conv_first, 0.1)
+        else:
+            mutil.initialize_weights(self.conv_first, 0.1)
+        mutil.initialize_weights(self.conv_last, 0)
+
+    def forward(self, x):
+        return self.conv_last(self.body(self.lrelu(self.conv_first(x))))
+
+
+class AutocastMixin(object):
+    '''Runs the convs of a subnet under autocast and returns FP32.
+
+    Only the subnet is in reduced precision: its output is cast back before the
+    coupling, so exp(s), the Jacobian and the losses are computed in FP32.
+    '''
+    autocast_dtype = torch.bfloat16
+
+    def forward(self, x):
+        with torch.autocast(x.device.type, dtype=self.autocast_dtype):
+            out = super(AutocastMixin, self).forward(x)
+        if isinstance(out, tuple):
+            return tuple(o.float() for o in out)
+        return out.float()
+
+
+class Bf16DenseBlock(AutocastMixin, DenseBlock):
+    pass
+
+
+class Bf16MemoryEfficientDenseBlock(AutocastMixin, MemoryEfficientDenseBlock):
+    pass
+
+
+class Bf16FusedDenseBlock(AutocastMixin, FusedDenseBlock):
+    pass
+
+
+def subnet(net_structure, init='xavier', memory_efficient=False, autocast=None, gc=32):
     def constructor(channel_in, channel_out):
         if net_structure == 'DBNet':
+            if autocast == 'bf16':
+                block = Bf16MemoryEfficientDenseBlock if memory_efficient else Bf16DenseBlock
+            elif autocast is None or autocast == 'fp32':
+                block = MemoryEfficientDenseBlock if memory_efficient else DenseBlock
+            else:
+                raise NotImplementedError('Subnet autocast [{:s}] not recognized.'.format(autocast))
             if init == 'xavier':
-                return DenseBlock(channel_in, channel_out, init)
+                return block(channel_in, channel_out, init, gc)
             else:
-                return DenseBlock(channel_in, channel_out)
+                return block(channel_in, channel_out, gc=gc)
+        elif net_structure in ('DSNet', 'GCNet', 'ResNet'):
+            if autocast not in (None, 'fp32'):
+                raise NotImplementedError('Subnet autocast is only available for DBNet.')
+            block = {'DSNet': DepthwiseSeparableDenseBlock, 'GCNet': GroupedDenseBlock,
+                     'ResNet': ResidualSubnet}[net_structure]
+            return block(channel_in, channel_out, init, gc)
         else:
             return None
 
@@ -0,0 +1,90 @@
+import logging
+from collections import OrderedDict
+
+import torch
+import torch.nn as nn
+
+logger = logging.getLogger('base')
+
+MODES = ('forward', 'reverse', 'downscale')
+
+
+class _Direction(nn.Module):
+    '''One execution direction of InvRescaleNet as a plain x -> out module'''
+    def __init__(self, net, mode):
+        super(_Direction, self).__init__()
+        self.net = net
+        self.mode = mode
+
+    def forward(self, x):
+        if self.mode == 'downscale':
+            return self.net.downscale(x)
+        return self.net(x, rev=self.mode == 'reverse', stateless=True)
+
+
+class CompiledInvRescaleNet(object):
+    '''Compiled graphs of an InvRescaleNet for inference.
+
+    backend 'inductor' uses torch.compile with automatic dynamic shapes, one compiled
+    module per direction: the first input shape gets a static graph, the first other
+    shape recompiles it once with dynamic batch, H and W, and that graph serves every
+    later shape (a recompile takes minutes on CPU, one per shape would also run into
+    the dynamo recompile limit and silently fall back to eager).
+    'trace' uses frozen TorchScript traces, which are static: one per direction and
+    input shape, of which the max_shapes most recently used are kept.
+    When a backend cannot compile on the current device (e.g. inductor without a C++
+    toolchain on a CPU box) it falls back to 'trace', then to eager execution.
+    The graphs capture the current weights: call clear() after loading new ones.
+    '''
+    def __init__(self, net, backend='inductor', max_shapes=8):
+        if isinstance(net, nn.DataParallel) or isinstance(net, nn.parallel.DistributedDataParallel):
+            net = net.module
+        assert backend in ('inductor', 'trace'), 'Unknown compile backend [{:s}].'.format(backend)
+        self.net = net
+        self.backend = backend
+        self.max_shapes = max_shapes
+        self.cache = OrderedDict()
+
+    def __call__(self, x, rev=False):
+        return self.run(x, 'reverse' if rev else 'forward')
+
+    def downscale(self, x):
+        return self.run(x, 'downscale')
+
+    def run(self, x, mode):
+        key = (mode, x.dtype, x.device)
+        if self.backend == 'trace':
+            key += (tuple(x.shape), )
+        fn = self.cache.pop(key, None)
+        if fn is None:
+            fn = self._compile(x, mode)
+            if self.backend == 'trace' and len(key) == 3:  # inductor failed, traces are per shape
+                key += (tuple(x.shape), )
+        self.cache[key] = fn  # most recently used last
+        while len(self.cache) > self.max_shapes:
+            self.cache.popitem(last=False)
+        with torch.no_grad():
+            return fn(x)
+
+    def clear(self):
+        self.cache = OrderedDict()
+
+    def _compile(self, x, mode):
+        module = _Direction(self.net, mode).eval()
+        backends = ['inductor', 'trace'] if self.backend == 'inductor' else ['trace']
+        for backend in backends:
+            try:
+                with torch.no_grad():
+                    if backend == 'inductor':
+                        fn = torch.compile(module, dynamic=None)
+                    else:
+                        fn = torch.jit.freeze(torch.jit.trace(module, x, check_trace=False))
+                    fn(x)  # compile now, so that failures fall back here
+                logger.info('Compiled netG [{:s}] for input {} with [{:s}].'.format(
+                    mode, tuple(x.shape), backend))
+                self.backend = backend
+                return fn
+            except Exception as e:
+                logger.warning('Compiling netG with [{:s}] failed: {}'.format(backend, e))
+        logger.warning('Running netG [{:s}] in eager mode.'.format(mode))
+        return module
@@ -0,0 +1,205 @@
+import json
+import weakref
+
+import torch
+import torch.nn as nn
+import torch.ao.nn.quantized as nnq
+from torch.utils._python_dispatch import TorchDispatchMode
+from models.modules.mkldnn_util import PrepackedConv2d
+
+# bytes per feature element, fitted by scripts/calibrate_memory.py on CPU, FP32, DBNet
+# with gc 16 and 32, block_num [4, 4] and [8, 8]; see MemoryModel.features
+DEFAULT_COEFS = {
+    'forward': [9., 8.],
+    'reverse': [8., 8.],
+    'train': [4.6378, 8.0532, 48.74, 0.1238],
+}
+
+
+class AllocationTracker(TorchDispatchMode):
+    '''Peak bytes of the tensors allocated inside the with block, above what was live on entry.
+
+    On CUDA this is torch.cuda.max_memory_allocated. Elsewhere every op output is
+    intercepted and its storage counted until it is freed, which sees the tensors of
+    all devices, but not the scratch memory a kernel allocates and frees internally.
+
+        with AllocationTracker(device) as t:
+            netG(x)
+        t.peak
+    '''
+    def __init__(self, device):
+        super(AllocationTracker, self).__init__()
+        self.device = torch.device(device)
+        self.live = self.peak = 0
+        self.storages = {}
+
+    def __enter__(self):
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+            torch.cuda.reset_peak_memory_stats(self.device)
+            self.base = torch.cuda.memory_allocated(self.device)
+            return self
+        return super(AllocationTracker, self).__enter__()
+
+    def __exit__(self, *args):
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+            self.peak = torch.cuda.max_memory_allocated(self.device) - self.base
+            return False
+        return super(AllocationTracker, self).__exit__(*args)
+
+    def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+        out = func(*args, **(kwargs or {}))
+        for t in (out if isinstance(out, (tuple, list)) else [out]):
+            if isinstance(t, torch.Tensor) and t.layout == torch.strided:
+                self._track(t.untyped_storage())
+        return out
+
+    def _track(self, storage):
+        key = storage.data_ptr()
+        if key in self.storages or storage.nbytes() == 0:
+            return  # in-place ops and views return storages that are counted already
+        nbytes = storage.nbytes()
+        self.storages[key] = weakref.ref(storage, lambda _: self._free(key, nbytes))
+        self.live += nbytes
+        self.peak = max(self.peak, self.live)
+
+    def _free(self, key, nbytes):
+        self.storages.pop(key, None)
+        self.live -= nbytes
+
+
+def load_coefs(path):
+    '''Coefficients saved by scripts/calibrate_memory.py'''
+    with open(path) as f:
+        return json.load(f)
+
+
+def conv_channels(m):
+    '''(in_channels, out_channels) of nn.Conv2d (also the QAT one), quantized and
+    PrepackedConv2d (cpu_backend: mkldnn) modules, None for anything else'''
+    if isinstance(m, (nn.Conv2d, nnq.Conv2d)):
+        return m.in_channels, m.out_channels
+    if isinstance(m, PrepackedConv2d):
+        return m.weight.shape[1] * m.groups, m.weight.shape[0]
+    return None
+
+
+def subnet_widths(subnet):
+    '''Output channels of all convs of a coupling subnet (growth and output channels), and
+    input plus output channels of all convs (what autograd keeps, the concatenated inputs
+    of a DenseBlock grow with every conv)'''
+    convs = [c for c in map(conv_channels, subnet.modules()) if c is not None]
+    if not convs:
+        raise NotImplementedError('No convs the memory model can read in subnet [{:s}].'.format(
+            subnet.__class__.__name__))
+    return sum(o for _, o in convs), sum(i + o for i, o in convs)
+
+
+class MemoryModel(object):
+    '''Peak activation memory of an InvRescaleNet, linear in a few size features.
+
+    levels is a list of (channels, [subnet_widths of F, G and H of every InvBlockExp]) per
+    Haar level. The weights, the input and everything allocated before the pass are not
+    counted. Without autograd (inference) the working set of one subnet dominates: the
+    features are the elements of the input and the widest output width times its pixels.
+    A training step (forward and reverse pass with grad, then backward) keeps the
+    activations of all blocks: the features are the image elements times the number of
+    InvBlockExp, the sum of input plus output width times pixels over all subnets, the
+    image elements and the number of parameters (gradients and the optimizer step, which
+    dominate on small patches).
+    coefs gives bytes per element of each feature for 'forward', 'reverse' and 'train';
+    the defaults were measured for FP32, scale them for other dtypes. The subnet convs
+    of autocast bf16 are counted as FP32, so the estimate stays an upper bound.
+    '''
+    def __init__(self, channel_in, levels, params=0, coefs=None, element_size=4):
+        self.channel_in = channel_in
+        self.levels = levels
+        self.params = params
+        self.coefs = coefs or DEFAULT_COEFS
+        self.scale = element_size / 4.
+
+    @classmethod
+    def from_net(cls, net, coefs=None, element_size=4):
+        '''Reads the levels from the modules, so pruned and resized subnets are counted as
+        they are'''
+        levels = []
+        for op in net.operations:
+            if not hasattr(op, 'F'):  # HaarDownsampling
+                levels.append((op.channel_in * 4, []))
+                continue
+            subnets = [op.F, op.GH] if hasattr(op, 'GH') else [op.F, op.G, op.H]
+            levels[-1][1].append([subnet_widths(s) for s in subnets])
+        params = sum(p.numel() for p in net.parameters())
+        return cls(levels[0][0] // 4, levels, params, coefs, element_size)
+
+    def features(self, shape, rev=False, train=False):
+        '''shape: N x C x H x W of the input, HR for the forward pass and LR for the reverse pass'''
+        N, C, H, W = shape
+        if rev:  # sizes on the HR grid
+            H, W = H * 2**len(self.levels), W * 2**len(self.levels)
+        elements = N * self.channel_in * H * W
+        blocks = []  # (pixels, subnet_widths of F, G, H) of every InvBlockExp
+        for level, (_, level_blocks) in enumerate(self.levels):
+            blocks += [(N * H * W / 4**(level + 1), subnets) for subnets in level_blocks]
+        if not train:
+            widest = [pixels * max(w for w, _ in subnets) for pixels, subnets in blocks]
+            return [elements, max(widest or [0])]
+        saved = sum(pixels * sum(io for _, io in subnets) for pixels, subnets in blocks)
+        return [elements * len(blocks), saved, elements, self.params]
+
+    def peak_bytes(self, shape, rev=False, train=False):
+        coefs = self.coefs['train' if train else 'reverse' if rev else 'forward']
+        return int(self.scale * sum(c * f for c, f in zip(coefs, self.features(shape, rev, train))))
+
+    def largest_batch(self, shape, budget, rev=False, train=False):
+        '''Largest N for images of shape (1 or N) x C x H x W within budget bytes, at least 1'''
+        per_image = self.peak_bytes((1, ) + tuple(shape[1:]), rev, train)
+        return max(1, int(budget // max(per_image, 1)))
+
+    def tiled_peak_bytes(self, shape, tile_size, rev=False):
+        '''Inference peak of tiled_forward: one tile, the copy of its input and its weighted
+        output, and the full-size output with its blend weights'''
+        N, C, H, W = shape
+        t_h, t_w = min(tile_size, H), min(tile_size, W)
+        # outputs have as many elements as their inputs, the blend weights one per output pixel
+        weight = H * W * 4**len(self.levels) if rev else H * W // 4**len(self.levels)
+        out = N * C * (H * W + 2 * t_h * t_w) + weight
+        return self.peak_bytes((N, C, t_h, t_w), rev) + int(self.scale * 4 * out)
+
+    def largest_tile(self, shape, budget, rev=False, tile_overlap=32):
+        '''tile_size (input pixels) for tiled_forward within budget bytes, None if the whole
+        image fits. Tiles are larger than tile_overlap (input pixels) and, for the HR input
+        of the forward pass, multiples of 2**down_num; the smallest one is returned when
+        none fits.'''
+        if self.peak_bytes(shape, rev) <= budget:
+            return None
+        step = 1 if rev else 2**len(self.levels)
+        lo = tile_overlap // step + 1  # in steps
+        hi = max(shape[2], shape[3]) // step
+        if lo >= hi:
+            return lo * step
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if self.tiled_peak_bytes(shape, mid * step, rev) <= budget:
+                lo = mid
+            else:
+                hi = mid - 1
+        return lo * step
+
+    @staticmethod
+    def fit(features, measured):
+        '''Least squares coefficients of relative error, negative ones are dropped and refitted'''
+        A = torch.tensor(features, dtype=torch.float64)
+        b = torch.tensor(measured, dtype=torch.float64)
+        A, b = A / b[:, None], torch.ones_like(b)
+        keep = list(range(A.shape[1]))
+        while True:
+            coefs = torch.linalg.lstsq(A[:, keep], b[:, None]).solution[:, 0]
+            if (coefs >= 0).all():
+                break
+            keep = [k for k, c in zip(keep, coefs) if c >= 0]
+        full = [0.] * A.shape[1]
+        for k, c in zip(keep, coefs.tolist()):
+            full[k] = c
+        return full
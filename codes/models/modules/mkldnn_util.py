@@ -0,0 +1,103 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from models.modules.Subnet_constructor import DenseBlock, AutocastMixin
+
+
+class PrepackedConv2d(nn.Module):
+    '''Conv2d with its weight reordered once into the oneDNN blocked format.
+
+    An optional LeakyReLU is fused into the convolution. weight and bias are the
+    Parameters of the source conv, so state_dicts and load_state_dict work as for
+    nn.Conv2d; the packed copy is rebuilt whenever the weight changes. With autograd
+    enabled or off the CPU it falls back to F.conv2d.
+    '''
+    def __init__(self, conv, negative_slope=None):
+        super(PrepackedConv2d, self).__init__()
+        self.weight = conv.weight
+        self.bias = conv.bias
+        self.stride, self.padding, self.dilation = conv.stride, conv.padding, conv.dilation
+        self.groups = conv.groups
+        self.negative_slope = negative_slope
+        self._packed = None
+        self._packed_version = None
+
+    def __getstate__(self):
+        # the packed weight is an opaque oneDNN tensor, rebuilt on the next call
+        state = self.__dict__.copy()
+        state['_packed'] = None
+        return state
+
+    def forward(self, x):
+        if torch.is_grad_enabled() or x.device.type != 'cpu' or x.dtype != torch.float32:
+            out = F.conv2d(x, self.weight, self.bias, self.stride, self.padding, self.dilation,
+                           self.groups)
+            return out if self.negative_slope is None else F.leaky_relu(out, self.negative_slope)
+
+        if self._packed is None or self._packed_version != self.weight._version:
+            self._packed = torch._C._nn.mkldnn_reorder_conv2d_weight(
+                self.weight.detach().to_mkldnn(), list(self.padding), list(self.stride),
+                list(self.dilation), self.groups)
+            self._packed_version = self.weight._version
+        if self.negative_slope is None:
+            attr, scalars = 'none', []
+        else:
+            attr, scalars = 'leaky_relu', [self.negative_slope]
+        return torch.ops.mkldnn._convolution_pointwise(
+            x, self._packed, self.bias, list(self.padding), list(self.stride), list(self.dilation),
+            self.groups, attr, scalars, '')
+
+
+class PrepackedDenseBlock(nn.Module):
+    '''DenseBlock on prepacked convs, conv1 to conv4 with their LeakyReLU fused.
+    Parameter names and outputs match the DenseBlock it is built from.'''
+    def __init__(self, block):
+        super(PrepackedDenseBlock, self).__init__()
+        self._wrap(block)
+        # the source module shares the Parameters and keeps the widths of pruned blocks
+        self.__dict__['source'] = block
+
+    def _wrap(self, block):
+        slope = block.lrelu.negative_slope
+        self.conv1 = PrepackedConv2d(block.conv1, slope)
+        self.conv2 = PrepackedConv2d(block.conv2, slope)
+        self.conv3 = PrepackedConv2d(block.conv3, slope)
+        self.conv4 = PrepackedConv2d(block.conv4, slope)
+        self.conv5 = PrepackedConv2d(block.conv5)
+
+    def _save_to_state_dict(self, destination, prefix, keep_vars):
+        super(PrepackedDenseBlock, self)._save_to_state_dict(destination, prefix, keep_vars)
+        if self.source.widths != self.source.configured_widths:
+            destination[prefix + 'pruned_widths'] = torch.tensor(self.source.widths)
+
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict, missing_keys,
+                              unexpected_keys, error_msgs):
+        # a pruned checkpoint resizes the source block, rewrap its new convs
+        widths = self.source.checkpoint_widths(state_dict, prefix)
+        if widths != self.source.widths:
+            self.source.resize(widths)
+            self._wrap(self.source)
+        super(PrepackedDenseBlock, self)._load_from_state_dict(
+            state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs)
+        if prefix + 'pruned_widths' in unexpected_keys:
+            unexpected_keys.remove(prefix + 'pruned_widths')
+
+    def forward(self, x):
+        x1 = self.conv1(x)
+        x2 = self.conv2(torch.cat((x, x1), 1))
+        x3 = self.conv3(torch.cat((x, x1, x2), 1))
+        x4 = self.conv4(torch.cat((x, x1, x2, x3), 1))
+        x5 = self.conv5(torch.cat((x, x1, x2, x3, x4), 1))
+
+        return x5
+
+
+def prepack(net):
+    '''Replace the DenseBlocks of net by PrepackedDenseBlocks, for CPU inference.
+    bf16 autocast subnets are left as they are.'''
+    for name, child in net.named_children():
+        if isinstance(child, DenseBlock) and not isinstance(child, AutocastMixin):
+            setattr(net, name, PrepackedDenseBlock(child))
+        else:
+            prepack(child)
+    return net
@@ -97,3 +97,78 @@ def flow_warp(x, flow, interp_mode='bilinear', padding_mode='zeros'):
     vgrid_scaled = torch.stack((vgrid_x, vgrid_y), dim=3)
     output = F.grid_sample(x, vgrid_scaled, mode=interp_mode, padding_mode=padding_mode)
     return output
+
+
+def geometric_transform(x, mode, inverse=False):
+    """One of the 8 flip / transpose transforms of an NCHW tensor, for self-ensembling
+    Args:
+        x (Tensor): size (N, C, H, W)
+        mode (int): 0-7, bit 0 flips W, bit 1 flips H, bit 2 transposes H and W
+        inverse (bool): undo the transform instead
+
+    Returns:
+        Tensor: transformed tensor, (N, C, W, H) when transposed
+    """
+    if inverse and mode & 4:
+        x = x.transpose(2, 3)
+    dims = [d for bit, d in ((1, 3), (2, 2)) if mode & bit]
+    if dims:
+        x = torch.flip(x, dims)
+    if not inverse and mode & 4:
+        x = x.transpose(2, 3)
+    return x
+
+
+def pad_to_multiple(x, multiple, mode='reflect'):
+    """Pad the bottom and right of an NCHW tensor to multiples of multiple
+    Args:
+        x (Tensor): size (N, C, H, W)
+        multiple (int): e.g. 2**down_num of an InvRescaleNet
+        mode (str): 'reflect' or 'replicate', reflect falls back to replicate on
+            images smaller than the padding
+
+    Returns:
+        Tensor: padded tensor, x itself when H and W already are multiples; x[:, :, :H, :W]
+            undoes the padding
+    """
+    H, W = x.shape[2:]
+    pad_h, pad_w = -H % multiple, -W % multiple
+    if not pad_h and not pad_w:
+        return x
+    if mode == 'reflect' and (pad_h >= H or pad_w >= W):
+        mode = 'replicate'
+    return F.pad(x, (0, pad_w, 0, pad_h), mode=mode)
+
+
+def run_grouped(imgs, fn, max_batch=None):
+    """Run fn on batches of the equally sized images of a list of mixed sizes
+    Args:
+        imgs (list[Tensor]): sizes (C, H, W) or (n, C, H, W)
+        fn: batched function, NCHW -> NCHW with the same N
+        max_batch: function of the image size (C, H, W) giving the largest N of one
+            call, an image of n > max_batch still runs in one call; no limit if None
+
+    Returns:
+        list[Tensor]: fn of every image, (n, C', H', W'), in the order of imgs
+    """
+    imgs = [x if x.dim() == 4 else x[None] for x in imgs]
+    groups = {}
+    for i, x in enumerate(imgs):
+        groups.setdefault(tuple(x.shape[1:]), []).append(i)
+    batches = []
+    for shape, idx in groups.items():
+        limit = max_batch(shape) if max_batch else None
+        batch, n = [], 0
+        for i in idx:
+            if batch and limit and n + imgs[i].shape[0] > limit:
+                batches.append(batch)
+                batch, n = [], 0
+            batch.append(i)
+            n += imgs[i].shape[0]
+        batches.append(batch)
+    out = [None] * len(imgs)
+    for idx in batches:
+        y = fn(torch.cat([imgs[i] for i in idx]) if len(idx) > 1 else imgs[idx[0]])
+        for i, part in zip(idx, torch.split(y, [imgs[i].shape[0] for i in idx])):
+            out[i] = part
+    return out
@@ -0,0 +1,56 @@
+from collections import OrderedDict
+
+import torch
+
+
+class LatentNoise(object):
+    '''Builds the reverse input y = [LR, z] with z ~ N(0, scale^2) drawn on the model device.
+
+    z is drawn in place into the z channels of y, so there is no host randn, copy,
+    multiply or torch.cat. With scale 0 the z channels are zero-filled, nothing is drawn.
+    Under torch.no_grad() y is a buffer kept per shape and reused by the next call with
+    that shape (the last max_buffers shapes are kept); it is only valid until then.
+    With autograd enabled every call returns a new tensor, gradients flow to LR.
+    '''
+    def __init__(self, device, max_buffers=4):
+        self.device = torch.device(device)
+        self.max_buffers = max_buffers
+        self.buffers = OrderedDict()
+
+    def generator(self, seed):
+        '''Generator on the model device, for reproducible draws (on that device type)'''
+        return torch.Generator(device=self.device).manual_seed(seed)
+
+    def with_latent(self, LR, z_channels, scale=1, generator=None):
+        '''[LR, z] with z_channels latent channels.
+        generator may be a list, one per equal split of the batch (e.g. one per sample).'''
+        N, C, h, w = LR.shape
+        shape = (N, C + z_channels, h, w)
+        if torch.is_grad_enabled():
+            y = torch.empty(shape, dtype=LR.dtype, device=self.device)
+        else:
+            y = self._buffer(shape, LR.dtype)
+        y[:, :C] = LR
+        if scale == 0:
+            y[:, C:].zero_()
+            return y
+        generators = generator if isinstance(generator, (list, tuple)) else [generator]
+        per_generator = N // len(generators)
+        for i in range(N):
+            # image by image: the z channels of one image are contiguous, normal_ on the
+            # strided batch slice is several times slower and draws a different sequence
+            y[i, C:].normal_(0, scale, generator=generators[i // per_generator])
+        return y
+
+    def _buffer(self, shape, dtype):
+        key = (shape, dtype)
+        buf = self.buffers.pop(key, None)
+        if buf is None:
+            buf = torch.empty(shape, dtype=dtype, device=self.device)
+        self.buffers[key] = buf  # most recently used last
+        while len(self.buffers) > self.max_buffers:
+            self.buffers.popitem(last=False)
+        return buf
+
+    def clear(self):
+        self.buffers.clear()
@@ -0,0 +1,141 @@
+import heapq
+
+import torch
+import torch.nn.functional as F
+from models.modules.Subnet_constructor import DenseBlock
+
+
+def dense_blocks(net):
+    return [(name, m) for name, m in net.named_modules() if isinstance(m, DenseBlock)]
+
+
+class ActivationStats(object):
+    '''Mean |LeakyReLU(conv)| of every growth channel of the DenseBlocks of net, and the
+    mean number of pixels each block runs on, collected with forward hooks.'''
+    def __init__(self, net):
+        self.sums, self.pixels, self.counts = {}, {}, {}
+        self.handles = []
+        for name, block in dense_blocks(net):
+            for j, conv in enumerate((block.conv1, block.conv2, block.conv3, block.conv4)):
+                self.handles.append(conv.register_forward_hook(self._hook((name, j), block.lrelu)))
+
+    def _hook(self, key, lrelu):
+        def hook(m, inp, out):
+            a = F.leaky_relu(out.detach(), lrelu.negative_slope).abs().mean((0, 2, 3))
+            self.sums[key] = self.sums.get(key, 0) + a
+            self.pixels[key] = self.pixels.get(key, 0) + out.shape[2] * out.shape[3]
+            self.counts[key] = self.counts.get(key, 0) + 1
+        return hook
+
+    def mean(self, name, j):
+        return self.sums[(name, j)] / self.counts[(name, j)]
+
+    def mean_pixels(self, name):
+        return self.pixels[(name, 0)] / self.counts[(name, 0)]
+
+    def remove(self):
+        for h in self.handles:
+            h.remove()
+
+
+def channel_scores(block, act_means):
+    '''Saliency of the growth channels of conv1 to conv4: mean |activation| times the
+    L2 norm of the weights of the later convs that read the channel'''
+    convs = [block.conv1, block.conv2, block.conv3, block.conv4, block.conv5]
+    offset = block.conv1.in_channels
+    scores = []
+    for j, width in enumerate(block.widths):
+        fan_out = sum(c.weight.detach()[:, offset:offset + width].pow(2).sum((0, 2, 3))
+                      for c in convs[j + 1:])
+        scores.append((act_means[j] * fan_out.sqrt()).cpu())
+        offset += width
+    return scores
+
+
+def block_macs(channel_in, channel_out, widths):
+    '''Multiply-accumulates per pixel of a DenseBlock with the given growth widths'''
+    macs, c = 0, channel_in
+    for w in list(widths) + [channel_out]:
+        macs += 9 * c * w
+        c += w
+    return macs
+
+
+def plan(net, stats, target, min_channels=4, multiple=1):
+    '''Growth channels to keep in every DenseBlock so that the MACs of all DenseBlocks
+    drop by the fraction target.
+
+    Channels are removed lowest score first, multiple at a time from one conv, so the
+    widths stay multiples of it (the conv kernels run much faster on such widths).
+    Scores are divided by the mean score of their block, so blocks on different levels
+    are comparable. Returns {block name: [kept indices of conv1, ..., conv4]}.
+    '''
+    blocks = dict(dense_blocks(net))
+    order, widths, pixels, heap = {}, {}, {}, []
+
+    def push(name, j):
+        # the next chunk of conv j, scored by its mean
+        chunk = order[(name, j)][:multiple]
+        if len(chunk) == multiple and widths[name][j] - multiple >= min_channels:
+            heapq.heappush(heap, (sum(v for v, _ in chunk) / multiple, name, j))
+
+    for name, block in blocks.items():
+        scores = channel_scores(block, [stats.mean(name, j) for j in range(4)])
+        mean = torch.cat(scores).mean().clamp_min(1e-12)
+        widths[name] = block.widths
+        pixels[name] = stats.mean_pixels(name)
+        for j, s in enumerate(scores):
+            order[(name, j)] = sorted((float(v / mean), k) for k, v in enumerate(s))
+            push(name, j)
+
+    def macs(name, w):
+        block = blocks[name]
+        return pixels[name] * block_macs(block.conv1.in_channels, block.conv5.out_channels, w)
+
+    total = sum(macs(name, w) for name, w in widths.items())
+    goal = total * (1 - target)
+    removed = {name: [set() for _ in range(4)] for name in blocks}
+    while total > goal and heap:
+        _, name, j = heapq.heappop(heap)
+        chunk, order[(name, j)] = order[(name, j)][:multiple], order[(name, j)][multiple:]
+        w = list(widths[name])
+        w[j] -= multiple
+        total += macs(name, w) - macs(name, widths[name])
+        widths[name] = w
+        removed[name][j].update(k for _, k in chunk)
+        push(name, j)
+
+    return {name: [[k for k in range(width) if k not in removed[name][j]]
+                   for j, width in enumerate(blocks[name].widths)] for name in blocks}
+
+
+def prune_block(block, keep):
+    '''Keep the growth channels keep[j] of conv{j+1}, j = 0..3. The block is resized in place.'''
+    device = block.conv1.weight.device
+    sd = block.state_dict()
+    # channels read by the next conv
+    inputs = [torch.arange(block.conv1.in_channels, device=device)]
+    offset = block.conv1.in_channels
+    for j, width in enumerate(block.widths + [None]):
+        name = 'conv{}'.format(j + 1)
+        idx = torch.cat(inputs)
+        w = sd[name + '.weight'][:, idx]
+        if width is not None:
+            out = torch.as_tensor(keep[j], dtype=torch.long, device=device)
+            w = w[out]
+            if name + '.bias' in sd:
+                sd[name + '.bias'] = sd[name + '.bias'][out]
+            inputs.append(out + offset)
+            offset += width
+        sd[name + '.weight'] = w.contiguous()
+    sd['pruned_widths'] = torch.tensor([len(k) for k in keep])
+    block.load_state_dict(sd)  # DenseBlock adopts the pruned widths on load
+    return block
+
+
+def prune(net, keep):
+    '''Apply a plan to net in place'''
+    blocks = dict(dense_blocks(net))
+    for name, k in keep.items():
+        prune_block(blocks[name], k)
+    return net
@@ -0,0 +1,98 @@
+import copy
+
+import torch
+import torch.nn as nn
+import torch.ao.quantization as tq
+from models.modules.Subnet_constructor import DenseBlock, growth_widths
+
+
+class QuantDenseBlock(nn.Module):
+    '''DenseBlock with the stubs eager-mode quantization needs.
+
+    Quantizes its input, runs conv1 to conv5 and the concatenations in int8 and
+    returns a float tensor, so the coupling arithmetic around it stays in float.
+    Parameter names match DenseBlock.
+    '''
+    def __init__(self, channel_in, channel_out, gc=32, bias=True):
+        super(QuantDenseBlock, self).__init__()
+        DenseBlock._build_convs(self, channel_in, channel_out, growth_widths(gc), bias)
+        # one activation and cat per use, each observes its own range
+        self.lrelus = nn.ModuleList([nn.LeakyReLU(negative_slope=0.2) for _ in range(4)])
+        self.cats = nn.ModuleList([nn.quantized.FloatFunctional() for _ in range(4)])
+        self.quant = tq.QuantStub()
+        self.dequant = tq.DeQuantStub()
+
+    def forward(self, x):
+        x = self.quant(x)
+        x1 = self.lrelus[0](self.conv1(x))
+        x2 = self.lrelus[1](self.conv2(self.cats[0].cat((x, x1), 1)))
+        x3 = self.lrelus[2](self.conv3(self.cats[1].cat((x, x1, x2), 1)))
+        x4 = self.lrelus[3](self.conv4(self.cats[2].cat((x, x1, x2, x3), 1)))
+        x5 = self.conv5(self.cats[3].cat((x, x1, x2, x3, x4), 1))
+
+        return self.dequant(x5)
+
+    @classmethod
+    def from_dense_block(cls, block):
+        q = cls(block.conv1.in_channels, block.conv5.out_channels, block.widths,
+                block.conv1.bias is not None)
+        state_dict = block.state_dict()
+        state_dict.pop('pruned_widths', None)  # the widths of q are built from block.widths
+        q.load_state_dict(state_dict)
+        return q.to(block.conv1.weight.device)
+
+
+def quantizable(net):
+    '''Replace every DenseBlock of net by a QuantDenseBlock with the same weights'''
+    for name, child in net.named_children():
+        if isinstance(child, DenseBlock):
+            setattr(net, name, QuantDenseBlock.from_dense_block(child))
+        else:
+            quantizable(child)
+    return net
+
+
+def _set_qconfig(net, qconfig):
+    for m in net.modules():
+        if isinstance(m, QuantDenseBlock):
+            m.qconfig = qconfig
+
+
+def prepare_ptq(net, backend='x86'):
+    '''Insert observers into the DenseBlock convs of net, for calibration in eval mode.
+    Everything outside the DenseBlocks (Haar transform, coupling) stays in float.'''
+    torch.backends.quantized.engine = backend
+    net = quantizable(net).eval()
+    _set_qconfig(net, tq.get_default_qconfig(backend))
+    return tq.prepare(net, inplace=True)
+
+
+def prepare_qat(net, backend='x86'):
+    '''Insert fake-quant modules into the DenseBlock convs of net, for fine-tuning'''
+    torch.backends.quantized.engine = backend
+    net = quantizable(net).train()
+    _set_qconfig(net, tq.get_default_qat_qconfig(backend))
+    return tq.prepare_qat(net, inplace=True)
+
+
+def convert(net):
+    '''Observed or fake-quantized net -> int8 DenseBlocks, for CPU inference'''
+    return tq.convert(net.eval(), inplace=True)
+
+
+def export_int8(net):
+    '''int8 copy of a QAT net, leaves net itself training'''
+    # tensors cached by the last forward (InvBlockExp.s, Haar last_jac) are part of the
+    # autograd graph and cannot be deep-copied
+    for m in net.modules():
+        for k, v in vars(m).items():
+            if torch.is_tensor(v) and v.grad_fn is not None:
+                setattr(m, k, v.detach())
+    return convert(copy.deepcopy(net).cpu())
+
+
+def load_quantized(net, load_path, backend='x86'):
+    '''Load a state_dict saved from a converted net into a float net of the same structure'''
+    net = convert(prepare_ptq(net.cpu(), backend))
+    net.load_state_dict(torch.load(load_path, map_location='cpu'))
+    return net
@@ -3,6 +3,7 @@ import logging
 import models.modules.discriminator_vgg_arch as SRGAN_arch
 from models.modules.Inv_arch import *
 from models.modules.Subnet_constructor import subnet
+from models.modules import mkldnn_util
 import math
 logger = logging.getLogger('base')
 
@@ -11,7 +12,20 @@ logger = logging.getLogger('base')
 # define network
 ####################
 def define_G(opt):
-    opt_net = opt['network_G']
+    return define_InvRescaleNet(opt['network_G'], opt['is_train'])
+
+
+#### Teacher for distillation
+def define_T(opt):
+    '''Frozen InvRescaleNet teacher, network_T takes the same keys as network_G'''
+    netT = define_InvRescaleNet(opt['network_T'], is_train=False)
+    netT.eval()
+    for p in netT.parameters():
+        p.requires_grad = False
+    return netT
+
+
+def define_InvRescaleNet(opt_net, is_train):
     which_model = opt_net['which_model_G']
     subnet_type = which_model['subnet_type']
     if opt_net['init']:
@@ -19,9 +33,29 @@ def define_G(opt):
     else:
         init = 'xavier'
 
+    gc = which_model['gc'] if which_model['gc'] else 32
+
     down_num = int(math.log(opt_net['scale'], 2))
 
-    netG = InvRescaleNet(opt_net['in_nc'], opt_net['out_nc'], subnet(subnet_type, init), opt_net['block_num'], down_num)
+    reversible = opt_net['reversible'] if opt_net['reversible'] else False
+    haar_conv = opt_net['haar_conv'] if opt_net['haar_conv'] else False
+    fuse_gh = opt_net['fuse_gh'] if opt_net['fuse_gh'] else False
+    memory_efficient = opt_net['memory_efficient'] if opt_net['memory_efficient'] else False
+    autocast = opt_net['autocast'] if opt_net['autocast'] else None
+    channels_last = opt_net['channels_last'] if opt_net['channels_last'] else False
+    cpu_backend = opt_net['cpu_backend'] if opt_net['cpu_backend'] else 'eager'
+    if fuse_gh and subnet_type != 'DBNet':
+        raise NotImplementedError('fuse_gh is only available for DBNet subnets.')
+    if cpu_backend not in ('eager', 'mkldnn'):
+        raise NotImplementedError('CPU backend [{:s}] not recognized.'.format(cpu_backend))
+
+    subnet_constructor = subnet(subnet_type, init, memory_efficient, autocast, gc)
+    netG = InvRescaleNet(opt_net['in_nc'], opt_net['out_nc'], subnet_constructor,
+                         opt_net['block_num'], down_num, reversible, haar_conv, fuse_gh,
+                         channels_last)
+    # prepacked convs are for inference, training keeps the standard modules
+    if cpu_backend == 'mkldnn' and not is_train:
+        netG = mkldnn_util.prepack(netG)
 
     return netG
 
@@ -24,6 +24,12 @@ def parse(opt_path, is_train=True):
         dataset['phase'] = phase
         if opt['distortion'] == 'sr':
             dataset['scale'] = scale
+        # NHWC batches for a channels_last netG
+        if opt.get('network_G', {}).get('channels_last', False):
+            dataset['channels_last'] = True
+        # padded instead of modcropped in the validation / test phase
+        if phase != 'train' and (opt.get('test') or {}).get('pad_mode'):
+            dataset['pad_mode'] = opt['test']['pad_mode']
         is_lmdb = False
         if dataset.get('dataroot_GT', None) is not None:
             dataset['dataroot_GT'] = osp.expanduser(dataset['dataroot_GT'])
@@ -66,6 +72,8 @@ def parse(opt_path, is_train=True):
     # network
     if opt['distortion'] == 'sr':
         opt['network_G']['scale'] = scale
+        if opt.get('network_T'):
+            opt['network_T']['scale'] = scale
 
     return opt
 
@@ -0,0 +1,97 @@
+'''FP32 vs bfloat16 DenseBlocks (network_G: autocast: bf16): throughput and accuracy.
+
+    python scripts/bench_autocast.py -opt options/test/test_IRN_x2.yml \\
+        options/test/test_IRN_x4.yml options/train/train_IRN_x2.yml \\
+        options/train/train_IRN_x4.yml -cpu
+
+Inference rows time both directions of netG on a -size HR image and report the PSNR of
+the bf16 LR/HR outputs against the FP32 ones. Train rows time a forward + reverse +
+backward step at the GT_size and batch_size of the option file and compare the losses.
+'''
+import argparse
+import math
+
+import torch
+import torch.nn.functional as F
+
+from bench_util import load_netG, timeit
+
+
+def psnr(a, b):
+    mse = (a.clamp(0, 1) - b.clamp(0, 1)).pow(2).mean().item()
+    return float('inf') if mse == 0 else 10 * math.log10(1. / mse)
+
+
+def train_step(netG, x, scale):
+    '''IRNModel losses with the default weights, no optimizer step'''
+    out = netG(x)
+    lr_ref = F.avg_pool2d(x, scale)
+    l_forw_fit = 16 * F.mse_loss(out[:, :3], lr_ref)
+    l_forw_ce = out[:, 3:].pow(2).sum() / x.shape[0]
+    y = torch.cat((out[:, :3], torch.randn_like(out[:, 3:])), 1)
+    l_back_rec = F.l1_loss(netG(y, rev=True)[:, :3], x, reduction='sum') / x.shape[0]
+    loss = l_forw_fit + l_forw_ce + l_back_rec
+    netG.zero_grad()
+    loss.backward()
+    return loss.detach()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-opt', type=str, nargs='+', required=True, help='Option YMAL files.')
+    parser.add_argument('-model', type=str, default='none',
+                        help='Override pretrain_model_G, none for random weights.')
+    parser.add_argument('-size', type=str, default='512x512', help='HR size for inference, HxW.')
+    parser.add_argument('-batch', type=int, default=None, help='Override batch_size of train rows.')
+    parser.add_argument('-repeat', type=int, default=5)
+    parser.add_argument('-cpu', action='store_true')
+    args = parser.parse_args()
+
+    print('{:>24s} {:>10s} {:>10s} {:>10s} {:>8s} {:>26s}'.format(
+        'option', 'pass', 'fp32 ms', 'bf16 ms', 'speedup', 'accuracy'))
+    for opt_path in args.opt:
+        opt, model, netG = load_netG(opt_path, args.model, args.cpu)
+        _, _, netG_bf16 = load_netG(opt_path, args.model, args.cpu, {'autocast': 'bf16'})
+        netG_bf16.load_state_dict(netG.state_dict())
+        scale, device = opt['scale'], model.device
+        name = opt_path.replace('\\', '/').split('/')[-1]
+
+        if opt['is_train'] or 'train' in opt['datasets']:
+            dataset_opt = opt['datasets']['train']
+            N, size = args.batch or dataset_opt['batch_size'], dataset_opt['GT_size']
+            x = torch.rand(N, 3, size, size, device=device)
+            netG.train()
+            netG_bf16.train()
+            torch.manual_seed(0)
+            t_fp = timeit(lambda: train_step(netG, x, scale), args.repeat)
+            t_bf = timeit(lambda: train_step(netG_bf16, x, scale), args.repeat)
+            torch.manual_seed(0)
+            l_fp = train_step(netG, x, scale)
+            torch.manual_seed(0)
+            l_bf = train_step(netG_bf16, x, scale)
+            grads = [(p.grad, q.grad) for p, q in zip(netG.parameters(), netG_bf16.parameters())
+                     if p.grad is not None]
+            g_err = max(((a - b).norm() / a.norm().clamp(min=1e-12)).item() for a, b in grads)
+            print('{:>24s} {:>10s} {:10.1f} {:10.1f} {:8.2f} {:>26s}'.format(
+                name, 'train', t_fp * 1e3, t_bf * 1e3, t_fp / t_bf,
+                'loss {:.2e} grad {:.2e}'.format(abs(l_fp - l_bf).item() / l_fp.item(), g_err)))
+            continue
+
+        H, W = [int(v) for v in args.size.split('x')]
+        x = torch.rand(1, 3, H, W, device=device)
+        with torch.no_grad():
+            lr = netG(x, stateless=True)
+            y = torch.cat((lr[:, :3], torch.randn_like(lr[:, 3:])), 1)
+            for rev, inp in [(False, x), (True, y)]:
+                t_fp = timeit(lambda: netG(inp, rev=rev, stateless=True, inplace=True), args.repeat)
+                t_bf = timeit(lambda: netG_bf16(inp, rev=rev, stateless=True, inplace=True),
+                              args.repeat)
+                ref = netG(inp, rev=rev, stateless=True)[:, :3]
+                out = netG_bf16(inp, rev=rev, stateless=True)[:, :3]
+                print('{:>24s} {:>10s} {:10.1f} {:10.1f} {:8.2f} {:>26s}'.format(
+                    name, 'reverse' if rev else 'forward', t_fp * 1e3, t_bf * 1e3, t_fp / t_bf,
+                    'PSNR vs fp32 {:.2f} dB'.format(psnr(out, ref))))
+
+
+if __name__ == '__main__':
+    main()
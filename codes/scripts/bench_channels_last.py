@@ -0,0 +1,54 @@
+'''NCHW vs channels_last (network_G: channels_last: true) execution of netG.
+
+    python scripts/bench_channels_last.py -opt options/test/test_IRN_x4.yml -cpu \\
+        -sizes 1080x1920 2160x3840
+
+Inputs of the channels_last model are given in NHWC, as LQGTDataset delivers them with
+channels_last, so no layout conversion is timed. Each row checks that the output is
+channels_last and reports its deviation from the NCHW model.
+'''
+import argparse
+
+import torch
+
+from bench_util import load_netG, timeit
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-opt', type=str, required=True, help='Path to test options YMAL file.')
+    parser.add_argument('-model', type=str, default=None,
+                        help='Override pretrain_model_G, none for random weights.')
+    parser.add_argument('-sizes', type=str, nargs='+', default=['1080x1920', '2160x3840'],
+                        help='HR sizes, HxW.')
+    parser.add_argument('-repeat', type=int, default=3)
+    parser.add_argument('-cpu', action='store_true')
+    args = parser.parse_args()
+
+    opt, model, netG = load_netG(args.opt, args.model, args.cpu, {'channels_last': False})
+    _, _, netG_cl = load_netG(args.opt, args.model, args.cpu, {'channels_last': True})
+    netG_cl.load_state_dict(netG.state_dict())
+    scale, device = opt['scale'], model.device
+
+    print('{:>12s} {:>10s} {:>10s} {:>10s} {:>8s} {:>10s}'.format(
+        'size', 'pass', 'NCHW ms', 'NHWC ms', 'speedup', 'max diff'))
+    for size in args.sizes:
+        H, W = [int(v) for v in size.split('x')]
+        x = torch.rand(1, 3, H, W, device=device)
+        y = torch.rand(1, 3 * scale**2, H // scale, W // scale, device=device)
+        with torch.no_grad():
+            for name, inp, fn in [('downscale', x, lambda net, t: net.downscale(t)),
+                                  ('upscale', y, lambda net, t: net(t, rev=True, inplace=True))]:
+                inp_cl = inp.contiguous(memory_format=torch.channels_last)
+                t = timeit(lambda: fn(netG, inp), args.repeat)
+                t_cl = timeit(lambda: fn(netG_cl, inp_cl), args.repeat)
+                out, out_cl = fn(netG, inp), fn(netG_cl, inp_cl)
+                cl = out_cl.is_contiguous(memory_format=torch.channels_last)
+                assert cl or out_cl.shape[1] == 1
+                print('{:>12s} {:>10s} {:10.1f} {:10.1f} {:8.2f} {:10.2e}'.format(
+                    size, name, t * 1e3, t_cl * 1e3, t / t_cl, (out - out_cl).abs().max().item()))
+                del out, out_cl
+
+
+if __name__ == '__main__':
+    main()
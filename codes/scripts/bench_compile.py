@@ -0,0 +1,54 @@
+'''Latency of eager and compiled netG per image size, both directions.
+
+    python scripts/bench_compile.py -opt options/test/test_IRN_x4.yml -sizes 256x256 512x512 \\
+        -backends trace inductor
+'''
+import argparse
+import time
+
+import torch
+
+from bench_util import load_netG, timeit
+from models.modules.compile_util import CompiledInvRescaleNet
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-opt', type=str, required=True, help='Path to test options YMAL file.')
+    parser.add_argument('-model', type=str, default=None,
+                        help='Override pretrain_model_G, none for random weights.')
+    parser.add_argument('-sizes', type=str, nargs='+', default=['256x256', '512x512'],
+                        help='HR sizes, HxW.')
+    parser.add_argument('-backends', type=str, nargs='+', default=['trace', 'inductor'])
+    parser.add_argument('-repeat', type=int, default=5)
+    parser.add_argument('-cpu', action='store_true')
+    args = parser.parse_args()
+
+    opt, model, netG = load_netG(args.opt, args.model, args.cpu)
+    scale = opt['scale']
+    compiled = {b: CompiledInvRescaleNet(netG, b) for b in args.backends}
+
+    header = '{:>12s} {:>10s} {:>10s}'.format('size', 'direction', 'eager (ms)')
+    for b in args.backends:
+        header += ' {:>14s} {:>12s}'.format(b + ' (ms)', 'compile (s)')
+    print(header)
+    for size in args.sizes:
+        H, W = [int(v) for v in size.split('x')]
+        x = torch.rand(1, 3, H, W, device=model.device)
+        y = torch.rand(1, 3 * scale**2, H // scale, W // scale, device=model.device)
+        for rev, inp in [(False, x), (True, y)]:
+            with torch.no_grad():
+                t_eager = timeit(lambda: netG(inp, rev=rev, stateless=True), args.repeat)
+            line = '{:>12s} {:>10s} {:10.1f}'.format(size, 'reverse' if rev else 'forward',
+                                                     t_eager * 1e3)
+            for b in args.backends:
+                start = time.time()
+                compiled[b](inp, rev=rev)  # first call compiles
+                t_compile = time.time() - start
+                t = timeit(lambda: compiled[b](inp, rev=rev), args.repeat, warmup=0)
+                line += ' {:14.1f} {:12.1f}'.format(t * 1e3, t_compile)
+            print(line)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+'''Latency of the eager netG against the prepacked oneDNN backend (network_G: cpu_backend: mkldnn).
+
+    python scripts/bench_cpu_backend.py -opt options/test/test_IRN_x4.yml -sizes 256x256 512x512
+
+Both models share the checkpoint; -channels_last runs both in NHWC. The first prepacked
+call includes the weight reorder, so it is excluded by the warm-up of timeit.
+'''
+import argparse
+
+import torch
+
+from bench_util import load_netG, timeit
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-opt', type=str, required=True, help='Path to test options YMAL file.')
+    parser.add_argument('-model', type=str, default=None,
+                        help='Override pretrain_model_G, none for random weights.')
+    parser.add_argument('-sizes', type=str, nargs='+', default=['256x256', '512x512'],
+                        help='HR sizes, HxW.')
+    parser.add_argument('-channels_last', action='store_true')
+    parser.add_argument('-repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    layout = {'channels_last': args.channels_last}
+    opt, _, netG = load_netG(args.opt, args.model, True, dict(layout, cpu_backend='eager'))
+    _, _, netG_pp = load_netG(args.opt, args.model, True, dict(layout, cpu_backend='mkldnn'))
+    netG_pp.load_state_dict(netG.state_dict())
+    scale = opt['scale']
+    fmt = torch.channels_last if args.channels_last else torch.contiguous_format
+
+    print('{:>12s} {:>10s} {:>10s} {:>10s} {:>8s} {:>10s}'.format(
+        'size', 'pass', 'eager ms', 'mkldnn ms', 'speedup', 'max diff'))
+    for size in args.sizes:
+        H, W = [int(v) for v in size.split('x')]
+        x = torch.rand(1, 3, H, W).contiguous(memory_format=fmt)
+        y = torch.rand(1, 3 * scale**2, H // scale, W // scale).contiguous(memory_format=fmt)
+        with torch.no_grad():
+            for name, inp, fn in [('downscale', x, lambda net, t: net.downscale(t)),
+                                  ('upscale', y, lambda net, t: net(t, rev=True, inplace=True))]:
+                t = timeit(lambda: fn(netG, inp), args.repeat)
+                t_pp = timeit(lambda: fn(netG_pp, inp), args.repeat)
+                diff = (fn(netG, inp) - fn(netG_pp, inp)).abs().max().item()
+                print('{:>12s} {:>10s} {:10.1f} {:10.1f} {:8.2f} {:10.2e}'.format(
+                    size, name, t * 1e3, t_pp * 1e3, t / t_pp, diff))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+'''Latency of the reshape and the convolution HaarDownsampling paths.
+
+    python scripts/bench_haar.py -sizes 1080x1920 2160x3840
+'''
+import argparse
+
+import torch
+
+from bench_util import timeit
+from models.modules.Inv_arch import HaarDownsampling
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-sizes', type=str, nargs='+', default=['1080x1920', '2160x3840'])
+    parser.add_argument('-channels', type=int, default=3)
+    parser.add_argument('-repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    haar_conv = HaarDownsampling(args.channels, use_conv=True).to(device)
+    haar = HaarDownsampling(args.channels).to(device)
+
+    print('{:>12s} {:>10s} {:>12s} {:>12s} {:>8s}'.format(
+        'size', 'direction', 'conv (ms)', 'reshape (ms)', 'equal'))
+    with torch.no_grad():
+        for size in args.sizes:
+            H, W = [int(v) for v in size.split('x')]
+            x = torch.rand(1, args.channels, H, W, device=device)
+            y = haar(x)
+            for rev, inp in [(False, x), (True, y)]:
+                t_conv = timeit(lambda: haar_conv(inp, rev=rev), args.repeat)
+                t_fast = timeit(lambda: haar(inp, rev=rev), args.repeat)
+                equal = torch.equal(haar_conv(inp, rev=rev), haar(inp, rev=rev))
+                print('{:>12s} {:>10s} {:12.2f} {:12.2f} {:>8s}'.format(
+                    size, 'reverse' if rev else 'forward', t_conv * 1e3, t_fast * 1e3, str(equal)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+'''Peak memory and allocations of one netG pass, per execution mode and image size.
+
+Every case runs in a fresh process. On GPU the peak comes from the CUDA allocator, on
+CPU it is the growth of the peak RSS during the pass. The number and volume of CPU
+allocations are counted with the autograd profiler.
+
+    python scripts/bench_memory.py -opt options/test/test_IRN_x4.yml -sizes 1080x1920 \\
+        -variant mode=inplace -set block_num=[2,2]
+'''
+import argparse
+import json
+import resource
+import subprocess
+import sys
+
+import torch
+
+from bench_netG import parse_variant
+from bench_util import load_netG
+
+RUN_KWARGS = ('mode', 'direction')
+
+
+def run_case(args, variant, size):
+    overrides = parse_variant(args.set)
+    overrides.update(parse_variant(variant))
+    run = {k: overrides.pop(k) for k in RUN_KWARGS if k in overrides}
+    mode = run.get('mode', 'stateless')
+    rev = run.get('direction', args.direction) == 'reverse'
+
+    opt, model, netG = load_netG(args.opt, args.model, args.cpu, overrides)
+    scale = opt['scale']
+    H, W = [int(v) for v in size.split('x')]
+    if rev:
+        x = torch.rand(1, 3 * scale**2, H // scale, W // scale, device=model.device)
+    else:
+        x = torch.rand(1, 3, H, W, device=model.device)
+
+    def fn():
+        with torch.no_grad():
+            if mode == 'downscale':
+                return netG.downscale(x)
+            return netG(x, rev=rev, stateless=True, inplace=(mode == 'inplace'))
+
+    on_gpu = x.is_cuda
+    if on_gpu:
+        torch.cuda.reset_peak_memory_stats()
+        base = torch.cuda.memory_allocated()
+    else:
+        base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    fn()
+    if on_gpu:
+        peak = torch.cuda.max_memory_allocated() - base
+    else:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 - base
+
+    with torch.autograd.profiler.profile(profile_memory=True) as prof:
+        fn()
+    allocs = [e.cpu_memory_usage for e in prof.function_events if e.cpu_memory_usage > 0]
+    return {'peak': peak, 'allocs': len(allocs), 'alloc_bytes': sum(allocs)}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-opt', type=str, required=True, help='Path to test options YMAL file.')
+    parser.add_argument('-model', type=str, default=None,
+                        help='Override pretrain_model_G, none for random weights.')
+    parser.add_argument('-sizes', type=str, nargs='+', default=['1080x1920', '2160x3840'],
+                        help='HR sizes, HxW.')
+    parser.add_argument('-direction', type=str, default='forward', choices=['forward', 'reverse'])
+    parser.add_argument('-variant', type=str, nargs='*', default=['mode=inplace'],
+                        help='compared against the baseline: mode=stateless|inplace|downscale, '
+                        'direction=forward|reverse and network_G overrides, key=value,...')
+    parser.add_argument('-set', type=str, default='', help='network_G overrides for all cases.')
+    parser.add_argument('-cpu', action='store_true')
+    parser.add_argument('-case', type=str, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case is not None:
+        variant, size = json.loads(args.case)
+        print(json.dumps(run_case(args, variant, size)))
+        return
+
+    print('{:>12s} {:>36s} {:>12s} {:>10s} {:>14s}'.format(
+        'size', 'variant', 'peak (MB)', 'allocs', 'alloc (MB)'))
+    for size in args.sizes:
+        for variant in [''] + args.variant:
+            cmd = [sys.executable] + sys.argv + ['-case', json.dumps([variant, size])]
+            out = subprocess.run(cmd, stdout=subprocess.PIPE, universal_newlines=True, check=True)
+            res = json.loads(out.stdout.strip().splitlines()[-1])
+            print('{:>12s} {:>36s} {:12.1f} {:10d} {:14.1f}'.format(
+                size, variant or 'baseline', res['peak'] / 2**20, res['allocs'],
+                res['alloc_bytes'] / 2**20))
+
+
+if __name__ == '__main__':
+    main()
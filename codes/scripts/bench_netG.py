@@ -0,0 +1,56 @@
+'''Latency of netG in both directions, optionally comparing network_G variants.
+
+    python scripts/bench_netG.py -opt options/test/test_IRN_x4.yml -sizes 256x256 512x512 \\
+        -variant fuse_gh=true
+'''
+import argparse
+import re
+
+import torch
+import yaml
+
+from bench_util import load_netG, timeit
+
+
+def parse_variant(s):
+    '''"key=value,key=value" -> dict of network_G overrides'''
+    overrides = {}
+    if s:
+        for kv in re.split(r',(?![^\[]*\])', s):  # commas inside [...] belong to lists
+            k, v = kv.split('=')
+            overrides[k] = yaml.safe_load(v)
+    return overrides
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-opt', type=str, required=True, help='Path to test options YMAL file.')
+    parser.add_argument('-model', type=str, default=None,
+                        help='Override pretrain_model_G, none for random weights.')
+    parser.add_argument('-sizes', type=str, nargs='+', default=['256x256', '512x512'],
+                        help='HR sizes, HxW.')
+    parser.add_argument('-variant', type=str, nargs='*', default=[],
+                        help='network_G overrides to compare against the baseline, key=value,...')
+    parser.add_argument('-repeat', type=int, default=5)
+    parser.add_argument('-cpu', action='store_true')
+    args = parser.parse_args()
+
+    variants = [''] + args.variant
+    print('{:>12s} {:>10s} {:>30s} {:>10s}'.format('size', 'direction', 'variant', 'ms'))
+    for variant in variants:
+        overrides = parse_variant(variant)
+        opt, model, netG = load_netG(args.opt, args.model, args.cpu, overrides)
+        scale = opt['scale']
+        for size in args.sizes:
+            H, W = [int(v) for v in size.split('x')]
+            x = torch.rand(1, 3, H, W, device=model.device)
+            y = torch.rand(1, 3 * scale**2, H // scale, W // scale, device=model.device)
+            with torch.no_grad():
+                for rev, inp in [(False, x), (True, y)]:
+                    t = timeit(lambda: netG(inp, rev=rev, stateless=True), args.repeat)
+                    print('{:>12s} {:>10s} {:>30s} {:10.1f}'.format(
+                        size, 'reverse' if rev else 'forward', variant or 'baseline', t * 1e3))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+'''Cost of building the reverse input [LR, z]: host randn, copy, multiply and cat (the
+former gaussian_batch path) against LatentNoise.with_latent, and the share of it in upscale.
+
+    python scripts/bench_noise.py -opt options/test/test_IRN_x4.yml -lr_sizes 128x128 512x512
+
+Also checks that seeded upscales are reproducible and that gaussian_scale 0 gives z = 0.
+'''
+import argparse
+
+import torch
+
+from bench_util import load_netG, timeit
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-opt', type=str, required=True, help='Path to test options YMAL file.')
+    parser.add_argument('-model', type=str, default=None,
+                        help='Override pretrain_model_G, none for random weights.')
+    parser.add_argument('-lr_sizes', type=str, nargs='+', default=['128x128', '512x512'],
+                        help='LR sizes, HxW.')
+    parser.add_argument('-batch', type=int, default=1)
+    parser.add_argument('-upscale', action='store_true', help='Also time the full upscale.')
+    parser.add_argument('-repeat', type=int, default=5)
+    parser.add_argument('-cpu', action='store_true')
+    args = parser.parse_args()
+
+    opt, model, _ = load_netG(args.opt, args.model, args.cpu)
+    scale = opt['scale']
+    zc = 3 * (scale**2 - 1)
+
+    lr = torch.rand(1, 3, 16, 16, device=model.device)
+    assert torch.equal(model.upscale(lr, scale, seed=1), model.upscale(lr, scale, seed=1))
+    assert model.noise.with_latent(lr, zc, 0)[:, 3:].abs().max() == 0
+
+    def old(lr, gaussian_scale):
+        z = torch.randn(lr.shape[0], zc, lr.shape[2], lr.shape[3]).to(model.device)
+        return torch.cat((lr, gaussian_scale * z), dim=1)
+
+    print('{:>10s} {:>6s} {:>12s} {:>12s} {:>8s}'.format(
+        'LR size', 'scale', 'cat(ms)', 'latent(ms)', 'speedup'))
+    with torch.no_grad():
+        for size in args.lr_sizes:
+            h, w = [int(v) for v in size.split('x')]
+            lr = torch.rand(args.batch, 3, h, w, device=model.device)
+            for gaussian_scale in (1, 0):
+                t_old = timeit(lambda: old(lr, gaussian_scale), args.repeat)
+                t_new = timeit(lambda: model.noise.with_latent(lr, zc, gaussian_scale), args.repeat)
+                print('{:>10s} {:6g} {:12.2f} {:12.2f} {:7.2f}x'.format(
+                    size, gaussian_scale, t_old * 1e3, t_new * 1e3, t_old / t_new))
+            if args.upscale:
+                t = timeit(lambda: model.upscale(lr, scale), args.repeat)
+                print('{:>10s} upscale {:.1f} ms'.format(size, t * 1e3))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+'''Startup cost and latency of inference_numpy against the torch model.
+
+    python scripts/bench_numpy_inference.py -opt options/test/test_IRN_x4.yml \\
+        -model ../experiments/pretrained_models/IRN_x4.pth -sizes 256x256 512x512
+
+Startup is measured in a fresh interpreter per engine: time and peak RSS from launch
+until the model is loaded and ready, which is what a short batch job pays.
+'''
+import argparse
+import os
+import os.path as osp
+import subprocess
+import sys
+import tempfile
+
+import numpy as np
+import torch
+
+from bench_util import load_netG, timeit
+
+CODES = osp.dirname(osp.dirname(osp.abspath(__file__)))
+sys.path.append(CODES)
+import inference_numpy  # noqa: E402
+
+STARTUP = '''
+import sys, time
+start = time.time()
+sys.path.insert(0, {codes!r})
+{body}
+elapsed = time.time() - start
+# VmHWM, ru_maxrss would include the parent's RSS inherited before exec
+hwm = [l for l in open('/proc/self/status') if l.startswith('VmHWM')][0].split()[1]
+print(elapsed, int(hwm) / 1024.)
+'''
+NUMPY_BODY = '''
+import inference_numpy
+net = inference_numpy.NumpyIRN({npz!r})
+'''
+TORCH_BODY = '''
+import options.options as option
+from models.modules.Inv_arch import InvRescaleNet
+from models.modules.Subnet_constructor import subnet
+import torch, math
+opt = option.dict_to_nonedict(option.parse({opt!r}, is_train=False))
+opt_net = opt['network_G']
+net = InvRescaleNet(opt_net['in_nc'], opt_net['out_nc'], subnet('DBNet'), opt_net['block_num'],
+                    int(math.log(opt_net['scale'], 2)))
+net.load_state_dict(torch.load({model!r}, map_location='cpu'))
+'''
+
+
+def startup(body, runs):
+    '''median seconds and MB of peak RSS'''
+    results = []
+    for _ in range(runs):
+        cmd = [sys.executable, '-c', STARTUP.format(codes=CODES, body=body)]
+        out = subprocess.check_output(cmd, stderr=subprocess.DEVNULL)
+        results.append([float(v) for v in out.decode().split()[-2:]])
+    results.sort()
+    return results[len(results) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-opt', type=str, required=True, help='Path to test options YMAL file.')
+    parser.add_argument('-model', type=str, required=True, help='*_G.pth checkpoint.')
+    parser.add_argument('-sizes', type=str, nargs='+', default=['256x256', '512x512'],
+                        help='HR sizes, HxW.')
+    parser.add_argument('-startup_runs', type=int, default=3)
+    parser.add_argument('-repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    opt, _, netG = load_netG(args.opt, args.model, cpu=True)
+    scale = opt['scale']
+    fd, npz = tempfile.mkstemp(suffix='.npz')
+    os.close(fd)
+    try:
+        inference_numpy.convert(args.model, npz)
+        net = inference_numpy.NumpyIRN(npz)
+        print('Converted model: {:.1f} MB (checkpoint {:.1f} MB)'.format(
+            osp.getsize(npz) / 2**20, osp.getsize(args.model) / 2**20))
+        t_np, mb_np = startup(NUMPY_BODY.format(npz=npz), args.startup_runs)
+        t_th, mb_th = startup(TORCH_BODY.format(opt=osp.abspath(args.opt), model=args.model),
+                              args.startup_runs)
+    finally:
+        os.remove(npz)
+    print('{:>10s} {:>12s} {:>14s}'.format('startup', 'seconds', 'peak RSS MB'))
+    print('{:>10s} {:12.2f} {:14.1f}'.format('torch', t_th, mb_th))
+    print('{:>10s} {:12.2f} {:14.1f}'.format('numpy', t_np, mb_np))
+
+    print('{:>12s} {:>10s} {:>10s} {:>10s} {:>8s}'.format(
+        'size', 'pass', 'torch ms', 'numpy ms', 'ratio'))
+    for size in args.sizes:
+        H, W = [int(v) for v in size.split('x')]
+        x = np.random.rand(1, 3, H, W).astype(np.float32)
+        y = np.random.rand(1, 3 * scale**2, H // scale, W // scale).astype(np.float32)
+        with torch.no_grad():
+            cases = [('downscale', lambda: netG.downscale(torch.from_numpy(x)),
+                      lambda: net.downscale(x)),
+                     ('upscale', lambda: netG(torch.from_numpy(y), rev=True, inplace=True),
+                      lambda: net.forward(y, rev=True))]
+            for name, t_fn, n_fn in cases:
+                t_t, t_n = timeit(t_fn, args.repeat), timeit(n_fn, args.repeat)
+                print('{:>12s} {:>10s} {:10.1f} {:10.1f} {:8.2f}'.format(
+                    size, name, t_t * 1e3, t_n * 1e3, t_n / t_t))
+
+
+if __name__ == '__main__':
+    main()
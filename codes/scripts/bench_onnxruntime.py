@@ -0,0 +1,56 @@
+'''CPU latency of the exported IRN graphs with onnxruntime. Needs only numpy and onnxruntime.
+
+    python scripts/bench_onnxruntime.py -onnx ../onnx/IRN_x4 -scale 4 -sizes 1080x1920
+'''
+import argparse
+import time
+
+import numpy as np
+import onnxruntime as ort
+
+
+def timeit(fn, repeat):
+    fn()
+    times = []
+    for _ in range(repeat):
+        t = time.time()
+        fn()
+        times.append(time.time() - t)
+    return sorted(times)[len(times) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-onnx', type=str, required=True,
+                        help='Path prefix given to export_onnx.py.')
+    parser.add_argument('-scale', type=int, required=True)
+    parser.add_argument('-sizes', type=str, nargs='+', default=['256x256', '512x512'],
+                        help='HR sizes, HxW.')
+    parser.add_argument('-threads', type=int, default=0, help='intra-op threads, 0 for default.')
+    parser.add_argument('-repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    so = ort.SessionOptions()
+    so.intra_op_num_threads = args.threads
+    start = time.time()
+    down = ort.InferenceSession(args.onnx + '_down.onnx', so, providers=['CPUExecutionProvider'])
+    up = ort.InferenceSession(args.onnx + '_up.onnx', so, providers=['CPUExecutionProvider'])
+    print('Sessions created in {:.2f}s'.format(time.time() - start))
+    z_input = len(up.get_inputs()) == 2
+
+    print('{:>12s} {:>16s} {:>14s}'.format('size', 'downscale (ms)', 'upscale (ms)'))
+    for size in args.sizes:
+        H, W = [int(v) for v in size.split('x')]
+        hr = np.random.rand(1, 3, H, W).astype(np.float32)
+        lr = down.run(None, {'HR': hr})[0]
+        feed = {'LR': lr}
+        if z_input:
+            feed['z'] = np.random.randn(1, 3 * (args.scale**2 - 1), H // args.scale,
+                                        W // args.scale).astype(np.float32)
+        t_down = timeit(lambda: down.run(None, {'HR': hr}), args.repeat)
+        t_up = timeit(lambda: up.run(None, feed), args.repeat)
+        print('{:>12s} {:16.1f} {:14.1f}'.format(size, t_down * 1e3, t_up * 1e3))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+'''x8 self-ensemble: eight IRNModel.test() calls on transformed inputs against the
+batched test: self_ensemble mode.
+
+    python scripts/bench_self_ensemble.py -opt options/test/test_IRN_x4.yml -size 256x256
+'''
+import argparse
+
+import torch
+
+from bench_util import load_netG, timeit
+import models.modules.module_util as mutil
+
+
+def naive(model, LQ, GT):
+    LR, SR = 0, 0
+    for mode in range(8):
+        model.feed_data({'LQ': mutil.geometric_transform(LQ, mode),
+                         'GT': mutil.geometric_transform(GT, mode)})
+        model.test()
+        LR = LR + mutil.geometric_transform(model.forw_L, mode, inverse=True)
+        SR = SR + mutil.geometric_transform(model.fake_H, mode, inverse=True)
+    return LR / 8, SR / 8
+
+
+def batched(model, LQ, GT):
+    model.feed_data({'LQ': LQ, 'GT': GT})
+    model.test()
+    return model.forw_L, model.fake_H
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-opt', type=str, required=True, help='Path to test options YMAL file.')
+    parser.add_argument('-model', type=str, default=None,
+                        help='Override pretrain_model_G, none for random weights.')
+    parser.add_argument('-size', type=str, default='256x256', help='HR size, HxW.')
+    parser.add_argument('-batches', type=int, nargs='+', default=[8, 4],
+                        help='ensemble_batch values to time.')
+    parser.add_argument('-repeat', type=int, default=3)
+    parser.add_argument('-cpu', action='store_true')
+    args = parser.parse_args()
+
+    opt, model, _ = load_netG(args.opt, args.model, args.cpu)
+    scale = opt['scale']
+    H, W = [int(v) for v in args.size.split('x')]
+    GT = torch.rand(1, 3, H, W, device=model.device)
+    LQ = torch.nn.functional.avg_pool2d(GT, scale)
+    for mode in range(8):
+        assert torch.equal(mutil.geometric_transform(mutil.geometric_transform(GT, mode), mode,
+                                                     inverse=True), GT)
+    model.test_opt['gaussian_scale'] = 0  # deterministic, the two modes then agree closely
+
+    model.test_opt['self_ensemble'] = False
+    LR_ref, SR_ref = naive(model, LQ, GT)
+    t_naive = timeit(lambda: naive(model, LQ, GT), args.repeat)
+    print('{:>18s} {:10.1f} ms'.format('8 x test()', t_naive * 1e3))
+    model.test_opt['self_ensemble'] = True
+    for batch in args.batches:
+        model.test_opt['ensemble_batch'] = batch
+        LR, SR = batched(model, LQ, GT)
+        t = timeit(lambda: batched(model, LQ, GT), args.repeat)
+        print('{:>18s} {:10.1f} ms  {:5.2f}x  LR diff {:.1e}  SR diff {:.1e}'.format(
+            'batch {}'.format(batch), t * 1e3, t_naive / t, (LR - LR_ref).abs().max().item(),
+            (SR - SR_ref).abs().max().item()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+'''Parameters, multiply-accumulates and latency of netG for each subnet_type.
+
+    python scripts/bench_subnets.py -opt options/test/test_IRN_x4.yml -model none -size 256x256
+
+The weights are random unless -model points to a checkpoint of the first type, the
+numbers only depend on the architecture. MACs are counted per HR image of the given size.
+'''
+import argparse
+
+import torch
+
+from bench_util import count_macs, load_netG, timeit
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-opt', type=str, required=True, help='Path to test options YMAL file.')
+    parser.add_argument('-model', type=str, default='none',
+                        help='Override pretrain_model_G, none for random weights.')
+    parser.add_argument('-types', type=str, nargs='+',
+                        default=['DBNet', 'DSNet', 'GCNet', 'ResNet'])
+    parser.add_argument('-gc', type=int, default=32)
+    parser.add_argument('-size', type=str, default='256x256', help='HR size, HxW.')
+    parser.add_argument('-repeat', type=int, default=5)
+    parser.add_argument('-cpu', action='store_true')
+    args = parser.parse_args()
+
+    H, W = [int(v) for v in args.size.split('x')]
+    print('{:>8s} {:>10s} {:>10s} {:>12s} {:>12s} {:>8s}'.format(
+        'subnet', 'params(K)', 'GMACs', 'forward(ms)', 'reverse(ms)', 'speedup'))
+    base = None
+    for t in args.types:
+        opt, model, netG = load_netG(args.opt, args.model if t == args.types[0] else 'none',
+                                     args.cpu, {'which_model_G': {'subnet_type': t, 'gc': args.gc}})
+        scale = opt['scale']
+        x = torch.rand(1, 3, H, W, device=model.device)
+        y = torch.rand(1, 3 * scale**2, H // scale, W // scale, device=model.device)
+        params = sum(p.numel() for p in netG.parameters())
+        macs = count_macs(netG, x, stateless=True)
+        with torch.no_grad():
+            t_fwd = timeit(lambda: netG(x, stateless=True), args.repeat)
+            t_rev = timeit(lambda: netG(y, rev=True, stateless=True), args.repeat)
+        base = base or t_fwd + t_rev
+        print('{:>8s} {:10.1f} {:10.2f} {:12.1f} {:12.1f} {:7.2f}x'.format(
+            t, params / 1e3, macs / 1e9, t_fwd * 1e3, t_rev * 1e3, base / (t_fwd + t_rev)))
+
+
+if __name__ == '__main__':
+    main()
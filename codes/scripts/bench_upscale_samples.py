@@ -0,0 +1,49 @@
+'''K stochastic upscalings: a loop of upscale calls against batched upscale_samples.
+
+    python scripts/bench_upscale_samples.py -opt options/test/test_IRN_x4.yml -k 16 -lr_size 64x64
+
+Also checks that seeded samples do not depend on the chunk size.
+'''
+import argparse
+
+import torch
+
+from bench_util import load_netG, timeit
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-opt', type=str, required=True, help='Path to test options YMAL file.')
+    parser.add_argument('-model', type=str, default=None,
+                        help='Override pretrain_model_G, none for random weights.')
+    parser.add_argument('-k', type=int, default=16, help='Number of latent samples.')
+    parser.add_argument('-lr_size', type=str, default='64x64', help='LR size, HxW.')
+    parser.add_argument('-chunks', type=int, nargs='+', default=[1, 4, 16],
+                        help='Samples per batched reverse pass.')
+    parser.add_argument('-repeat', type=int, default=3)
+    parser.add_argument('-cpu', action='store_true')
+    args = parser.parse_args()
+
+    opt, model, _ = load_netG(args.opt, args.model, args.cpu)
+    scale = opt['scale']
+    h, w = [int(v) for v in args.lr_size.split('x')]
+    lr = torch.rand(1, 3, h, w, device=model.device)
+    seeds = list(range(args.k))
+
+    ref = model.upscale_samples(lr, scale, args.k, seeds, chunk=1)
+    for chunk in args.chunks:
+        out = model.upscale_samples(lr, scale, args.k, seeds, chunk=chunk)
+        assert torch.allclose(out, ref, atol=1e-5), \
+            'chunk {} changed the seeded samples'.format(chunk)
+
+    t_loop = timeit(lambda: [model.upscale(lr, scale) for _ in range(args.k)], args.repeat)
+    print('{:>22s} {:10.1f} ms'.format('loop of upscale', t_loop * 1e3))
+    for chunk in args.chunks:
+        t = timeit(lambda: model.upscale_samples(lr, scale, args.k, chunk=chunk, stats=True),
+                   args.repeat)
+        print('{:>22s} {:10.1f} ms  {:5.2f}x'.format(
+            'samples, chunk {}'.format(chunk), t * 1e3, t_loop / t))
+
+
+if __name__ == '__main__':
+    main()
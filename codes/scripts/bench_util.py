@@ -0,0 +1,94 @@
+'''Helpers shared by the benchmark and check scripts'''
+import os.path as osp
+import sys
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+sys.path.append(osp.dirname(osp.dirname(osp.abspath(__file__))))
+import options.options as option  # noqa: E402
+from models import create_model  # noqa: E402
+import utils.util as util  # noqa: E402
+
+
+def load_netG(opt_path, model_path=None, cpu=False, network_opt=None):
+    '''Build netG from a test option file and load its pretrained weights.
+    network_opt overrides entries of network_G.'''
+    opt = option.parse(opt_path, is_train=False)
+    if network_opt:
+        opt['network_G'].update(network_opt)
+    opt = option.dict_to_nonedict(opt)
+    if cpu:
+        opt['gpu_ids'] = None
+    if model_path is not None:
+        # 'none' benchmarks randomly initialized weights
+        opt['path']['pretrain_model_G'] = None if model_path == 'none' else model_path
+    model = create_model(opt)
+    netG = model.netG.module
+    netG.eval()
+    return opt, model, netG
+
+
+def timeit(fn, repeat=5, warmup=1):
+    '''Median wall time of fn() in seconds'''
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        t = time.time()
+        fn()
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        times.append(time.time() - t)
+    times.sort()
+    return times[len(times) // 2]
+
+
+def count_macs(net, x, **kwargs):
+    '''Multiply-accumulates of the Conv2d layers in net(x, **kwargs)'''
+    macs = []
+
+    def hook(m, inp, out):
+        k = m.kernel_size[0] * m.kernel_size[1]
+        macs.append(out.numel() * m.in_channels // m.groups * k)
+
+    handles = [m.register_forward_hook(hook) for m in net.modules() if isinstance(m, nn.Conv2d)]
+    with torch.no_grad():
+        net(x, **kwargs)
+    for h in handles:
+        h.remove()
+    return sum(macs)
+
+
+def train_iters(model, train_loader, niter, warmup_iter=-1):
+    '''niter training iterations of model, cycling through train_loader'''
+    step = 0
+    while step < niter:
+        for train_data in train_loader:
+            step += 1
+            if step > niter:
+                break
+            model.feed_data(train_data)
+            model.optimize_parameters(step)
+            model.update_learning_rate(step, warmup_iter=warmup_iter)
+
+
+def validate(model, val_loader, n_val=None):
+    '''Mean SR PSNR of model.test() on val_loader, scale pixels cropped as in train.py'''
+    psnrs = []
+    crop = model.opt['scale']
+    for i, val_data in enumerate(val_loader):
+        if n_val and i >= n_val:
+            break
+        model.feed_data(val_data)
+        model.test()
+        visuals = model.get_current_visuals()
+        sr_img = util.tensor2img(visuals['SR'])
+        gt_img = util.tensor2img(visuals['GT'])
+        psnrs.append(util.calculate_psnr(sr_img[crop:-crop, crop:-crop],
+                                         gt_img[crop:-crop, crop:-crop]))
+    return float(np.mean(psnrs))
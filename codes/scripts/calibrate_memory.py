@@ -0,0 +1,105 @@
+'''Fits the coefficients of the peak activation memory model (models/modules/memory_util.py)
+to allocations measured on this device.
+
+    python scripts/calibrate_memory.py -opt options/train/train_IRN_x4.yml -gc 16 32 -blocks 4 8 \\
+        -sizes 64x64 256x192 -train_sizes 48 96 -save ../experiments/memory_cpu.json
+
+Inference peaks are measured for the forward and the reverse pass of netG as test() runs
+them, training peaks for one IRNModel.optimize_parameters step on random batches.
+Every configuration of -gc and -blocks is measured with batch 1 and -batch; the fit is
+printed with the error of every point. Point test: memory_calibration to the saved file.
+'''
+import argparse
+import json
+
+import torch
+
+from search_arch import load_opt, parse_blocks
+import options.options as option
+from models import create_model
+from models.modules.memory_util import AllocationTracker, MemoryModel
+
+
+def measure(model, shape, mode):
+    netG = model.netG.module
+    device = model.device
+    if mode == 'train':
+        N, C, H, W = shape
+        scale = model.opt['scale']
+        model.feed_data({'GT': torch.rand(shape), 'LQ': torch.rand(N, C, H // scale, W // scale)})
+        model.optimize_parameters(1)  # optimizer state and grads exist before the measurement
+        with AllocationTracker(device) as t:
+            model.optimize_parameters(2)
+        return t.peak
+    x = torch.rand(shape, device=device)
+    netG.eval()
+    with torch.no_grad(), AllocationTracker(device) as t:
+        netG(x, rev=mode == 'reverse', stateless=True, inplace=True)
+    netG.train()
+    return t.peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-opt', type=str, required=True, help='Path to training options YMAL file.')
+    parser.add_argument('-gc', type=int, nargs='+', default=[16, 32])
+    parser.add_argument('-blocks', type=str, nargs='+', default=['4', '8'],
+                        help='block_num per level, comma separated, one value for all levels.')
+    parser.add_argument('-sizes', type=str, nargs='+', default=['64x64', '192x128'],
+                        help='HR sizes of the inference passes, HxW.')
+    parser.add_argument('-train_sizes', type=int, nargs='+', default=[48, 96],
+                        help='GT_size of the steps.')
+    parser.add_argument('-batch', type=int, default=2)
+    parser.add_argument('-save', type=str, default=None,
+                        help='Where to save the coefficients (json).')
+    parser.add_argument('-cpu', action='store_true')
+    args = parser.parse_args()
+
+    scale = option.parse(args.opt, is_train=False)['scale']
+    down_num = scale.bit_length() - 1
+    points = {'forward': [], 'reverse': [], 'train': []}
+    for gc in args.gc:
+        for blocks in args.blocks:
+            opt = load_opt(args.opt, parse_blocks(blocks, down_num), gc, args.cpu)
+            opt['path']['pretrain_model_G'] = None
+            opt['path']['resume_state'] = None
+            model = create_model(opt)
+            memory = MemoryModel.from_net(model.netG.module)
+            C = opt['network_G']['in_nc']
+            for N in (1, args.batch):
+                for size in args.sizes:
+                    H, W = [int(v) for v in size.split('x')]
+                    for mode, shape in (('forward', (N, C, H, W)),
+                                        ('reverse', (N, C * scale**2, H // scale, W // scale))):
+                        points[mode].append(('{}/{}/{}x{}'.format(gc, blocks, N, size), shape,
+                                             memory.features(shape, mode == 'reverse'),
+                                             measure(model, shape, mode)))
+                for size in args.train_sizes:
+                    shape = (N, C, size, size)
+                    points['train'].append(('{}/{}/{}x{}'.format(gc, blocks, N, size), shape,
+                                            memory.features(shape, train=True),
+                                            measure(model, shape, 'train')))
+
+    coefs = {mode: MemoryModel.fit([p[2] for p in ps], [p[3] for p in ps])
+             for mode, ps in points.items()}
+    memory = MemoryModel(None, None, coefs=coefs)
+    print('{:>8s} {:>24s} {:>12s} {:>12s} {:>8s}'.format(
+        'mode', 'gc/blocks/NxHxW', 'measured(MB)', 'estimate(MB)', 'error'))
+    for mode, ps in points.items():
+        errors = []
+        for name, shape, features, measured in ps:
+            estimate = sum(c * f for c, f in zip(coefs[mode], features))
+            errors.append(estimate / measured - 1)
+            print('{:>8s} {:>24s} {:12.1f} {:12.1f} {:+7.1%}'.format(
+                mode, name, measured / 2**20, estimate / 2**20, errors[-1]))
+        print('{:>8s} coefs {} mean |error| {:.1%}, max {:.1%}'.format(
+            mode, ['{:.4f}'.format(c) for c in coefs[mode]],
+            sum(abs(e) for e in errors) / len(errors), max(abs(e) for e in errors)))
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(memory.coefs, f, indent=2)
+        print('Saved {:s}'.format(args.save))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+'''Parity of inference_numpy.NumpyIRN with InvRescaleNet for a checkpoint.
+
+    python scripts/check_numpy_inference.py -opt options/test/test_IRN_x4.yml \\
+        -model ../experiments/pretrained_models/IRN_x4.pth
+
+Converts the checkpoint, runs forward, reverse and downscale on random inputs with both
+engines and fails when the max abs difference exceeds -tol.
+'''
+import argparse
+import os
+import os.path as osp
+import sys
+import tempfile
+
+import numpy as np
+import torch
+
+from bench_util import load_netG
+
+sys.path.append(osp.dirname(osp.dirname(osp.abspath(__file__))))
+import inference_numpy  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-opt', type=str, required=True, help='Path to test options YMAL file.')
+    parser.add_argument('-model', type=str, required=True, help='*_G.pth checkpoint.')
+    parser.add_argument('-size', type=str, default='64x96', help='HR size, HxW.')
+    parser.add_argument('-batch', type=int, default=2)
+    parser.add_argument('-half', action='store_true', help='Check a float16 conversion.')
+    parser.add_argument('-tol', type=float, default=None, help='Default 1e-4, 1e-3 with -half.')
+    args = parser.parse_args()
+
+    tol = args.tol if args.tol is not None else (1e-3 if args.half else 1e-4)
+    opt, _, netG = load_netG(args.opt, args.model, cpu=True)
+    scale = opt['scale']
+    fd, path = tempfile.mkstemp(suffix='.npz')
+    os.close(fd)
+    try:
+        inference_numpy.convert(args.model, path, args.half)
+        net = inference_numpy.NumpyIRN(path)
+    finally:
+        os.remove(path)
+    assert net.scale == scale, 'Checkpoint scale {} does not match the options.'.format(net.scale)
+
+    H, W = [int(v) for v in args.size.split('x')]
+    rng = np.random.default_rng(0)
+    x = rng.random((args.batch, 3, H, W), dtype=np.float32)
+    y = rng.standard_normal((args.batch, 3 * scale**2, H // scale, W // scale), dtype=np.float32)
+    y[:, :3] = rng.random((args.batch, 3, H // scale, W // scale), dtype=np.float32)
+    failed = False
+    with torch.no_grad():
+        for name, ref, out in [
+                ('forward', netG(torch.from_numpy(x)), net.forward(x)),
+                ('reverse', netG(torch.from_numpy(y), rev=True), net.forward(y, rev=True)),
+                ('downscale', netG.downscale(torch.from_numpy(x)), net.downscale(x))]:
+            diff = np.abs(ref.numpy() - out).max()
+            failed = failed or diff > tol
+            print('{:>10s} max abs diff {:.2e} {:s}'.format(
+                name, diff, 'FAIL' if diff > tol else 'ok'))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
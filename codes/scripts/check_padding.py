@@ -0,0 +1,92 @@
+'''Checks the pad-to-multiple path of IRNModel on sizes that are not multiples of the scale.
+
+    python scripts/check_padding.py -opt options/test/test_IRN_x4.yml -sizes 130x97 64x64 61x200
+
+- an image that already is a multiple of the scale gives the same output as before,
+- downscale gives an LR of ceil(H / scale) x ceil(W / scale), upscale with size= and
+  test() give back exactly H x W, also with a floor(H / scale) x floor(W / scale) LR_ref
+  (a dataroot_LQ made by floor), whose LR metric test.py computes on the LR_ref size,
+- a list of images of mixed sizes gives the same results as running them one by one,
+- the PSNR of the round trip with reflect, replicate and zero padding.
+'''
+import argparse
+
+import torch
+
+from bench_util import load_netG, timeit
+import utils.util as util
+
+
+def psnr(a, b):
+    return util.calculate_psnr(util.tensor2img(a[0]).astype(float),
+                               util.tensor2img(b[0]).astype(float))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-opt', type=str, required=True, help='Path to test options YMAL file.')
+    parser.add_argument('-model', type=str, default=None,
+                        help='Override pretrain_model_G, none for random weights.')
+    parser.add_argument('-sizes', type=str, nargs='+', default=['130x97', '64x64', '61x200'],
+                        help='HR sizes, HxW.')
+    parser.add_argument('-repeat', type=int, default=3)
+    parser.add_argument('-cpu', action='store_true')
+    args = parser.parse_args()
+
+    opt, model, _ = load_netG(args.opt, args.model, args.cpu)
+    scale = opt['scale']
+    torch.manual_seed(0)
+    imgs = []
+    for size in args.sizes:
+        H, W = [int(v) for v in size.split('x')]
+        # smooth content, so that the padded borders matter as they do on photos
+        x = torch.nn.functional.interpolate(torch.rand(1, 3, H // 8 + 2, W // 8 + 2), size=(H, W),
+                                            mode='bilinear', align_corners=False)
+        imgs.append(x.to(model.device))
+
+    def round_trip(x, mode=None):
+        if mode is not None:
+            model.test_opt['pad_mode'] = mode
+        LR = model.downscale(x)
+        return LR, model.upscale(LR, scale, gaussian_scale=0, size=x.shape[2:])
+
+    print('{:>10s} {:>10s} {:>9s} {:>9s} {:>9s} {:>10s}'.format(
+        'HR size', 'LR size', 'reflect', 'replicate', 'constant', 'time(ms)'))
+    for size, x in zip(args.sizes, imgs):
+        H, W = x.shape[2:]
+        LR, HR = round_trip(x, 'reflect')
+        assert LR.shape[2:] == (-(-H // scale), -(-W // scale)) and HR.shape[2:] == (H, W)
+        if H % scale == 0 and W % scale == 0:
+            net = model.netG.module
+            with torch.no_grad():
+                assert torch.equal(LR, model.Quantization(net.downscale(x)[:, :3]))
+
+        model.real_H, model.ref_L = x, LR
+        model.test()
+        assert model.fake_H.shape[2:] == (H, W)
+        model.ref_L = LR[:, :, :H // scale, :W // scale]
+        model.test()
+        assert model.fake_H.shape[2:] == (H, W)
+        visuals = model.get_current_visuals()
+        lr_img, lrgt_img = util.tensor2img(visuals['LR']), util.tensor2img(visuals['LR_ref'])
+        lr_img = lr_img[:lrgt_img.shape[0], :lrgt_img.shape[1]]  # as test.py
+        util.calculate_psnr(lr_img, lrgt_img), util.calculate_ssim(lr_img, lrgt_img)
+
+        row = [psnr(round_trip(x, mode)[1], x) for mode in ('reflect', 'replicate', 'constant')]
+        model.test_opt['pad_mode'] = 'reflect'
+        t = timeit(lambda: round_trip(x), args.repeat)
+        print('{:>10s} {:>10s} {:9.2f} {:9.2f} {:9.2f} {:10.1f}'.format(
+            size, '{}x{}'.format(*LR.shape[2:]), *row, t * 1e3))
+
+    # mixed sizes in one call, images of the same padded size share a batch
+    LRs = model.downscale(imgs + imgs)
+    HRs = model.upscale(LRs, scale, gaussian_scale=0, size=[x.shape[2:] for x in imgs + imgs])
+    for x, LR, HR in zip(imgs + imgs, LRs, HRs):
+        LR_1, HR_1 = round_trip(x)
+        assert torch.allclose(LR, LR_1, atol=1e-5) and torch.allclose(HR, HR_1, atol=1e-5)
+        assert HR.shape[2:] == x.shape[2:]
+    print('mixed-size batch of {} images matches the single runs'.format(len(LRs)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+'''Checks that reversible backpropagation gives the gradients of the stored-activation
+pass, on the module itself and on a DataParallel replica, and that its activation
+memory does not grow with block_num.
+
+    python scripts/check_reversible.py
+
+A replica made by nn.parallel.replicate has no parameters(), its weights are
+broadcast copies set as plain attributes. The replica is simulated on the CPU the
+same way (views of the parameters stand in for the broadcast copies), so the check
+runs without GPUs. The activation memory of a training step is its peak allocation
+(memory_util.AllocationTracker) minus the weight gradients, which grow with depth in
+any case. Exits nonzero when a gradient is missing or deviates, or when the
+activation memory of the deepest -blocks exceeds the shallowest by more than -mem_tol.
+'''
+import argparse
+import sys
+
+import torch
+
+import bench_util  # noqa: F401, puts codes/ on the path
+from models.modules.Inv_arch import InvRescaleNet
+from models.modules.memory_util import AllocationTracker
+from models.modules.Subnet_constructor import subnet
+
+
+def replicate(net):
+    '''What nn.parallel.replicate builds for one device, without the Broadcast'''
+    modules = list(net.modules())
+    copies = [m._replicate_for_data_parallel() for m in modules]
+    index = {id(m): i for i, m in enumerate(modules)}
+    for m, r in zip(modules, copies):
+        for key, child in m._modules.items():
+            r._modules[key] = None if child is None else copies[index[id(child)]]
+        r._former_parameters = {}
+        for key, p in m._parameters.items():
+            if p is None:
+                r._parameters[key] = None
+            else:
+                p_copy = p.view_as(p)
+                setattr(r, key, p_copy)
+                r._former_parameters[key] = p_copy
+    return copies[0]
+
+
+def grads(net, x, rev, replica):
+    net.zero_grad()
+    run = replicate(net) if replica else net
+    out = run(x, rev=rev)
+    (out**2).mean().backward()
+    return {k: p.grad for k, p in net.named_parameters()}
+
+
+def activation_memory(block_num, reversible, shape):
+    torch.manual_seed(0)
+    net = InvRescaleNet(3, 3, subnet('DBNet', 'xavier', gc=8), [block_num] * 2, 2,
+                        reversible=reversible)
+    x = torch.rand(shape)
+    with AllocationTracker('cpu') as t:
+        (net(x)**2).mean().backward()
+    grads = sum(p.numel() * p.element_size() for p in net.parameters() if p.requires_grad)
+    return t.peak - grads
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-tol', type=float, default=1e-4, help='Max relative gradient deviation.')
+    parser.add_argument('-blocks', type=int, nargs='+', default=[2, 8, 16],
+                        help='block_num per level of the memory check.')
+    parser.add_argument('-mem_tol', type=float, default=0.05,
+                        help='Max relative growth of the reversible activation memory.')
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    net = InvRescaleNet(3, 3, subnet('DBNet', 'xavier', gc=8), [2, 2], 2)
+    with torch.no_grad():  # the last convs start at zero, which makes every block the identity
+        for p in net.parameters():
+            if p.requires_grad:
+                p.add_(0.05 * torch.randn_like(p))
+    failed = False
+    for rev in (False, True):
+        x = torch.rand(2, 3, 16, 16) if not rev else torch.rand(2, 48, 4, 4)
+        net.reversible = False
+        ref = grads(net, x, rev, False)
+        net.reversible = True
+        for replica in (False, True):
+            got = grads(net, x, rev, replica)
+            keys = [k for k in ref if ref[k] is not None]
+            missing = [k for k in keys if got[k] is None]
+            dev = max([(got[k] - ref[k]).abs().max().item() / max(ref[k].abs().max().item(), 1e-12)
+                       for k in keys if got[k] is not None] or [0.])
+            ok = not missing and dev <= args.tol
+            failed |= not ok
+            print('{:8s} {:8s} missing grads: {:3d} max rel. deviation: {:.2e} {}'.format(
+                'reverse' if rev else 'forward', 'replica' if replica else 'module', len(missing),
+                dev, 'ok' if ok else 'FAILED'))
+
+    shape = (2, 3, 96, 96)
+    print('{:>10s} {:>16s} {:>16s}'.format('block_num', 'stored (MB)', 'reversible (MB)'))
+    mems = []
+    for b in args.blocks:
+        mems.append(activation_memory(b, True, shape))
+        print('{:>10d} {:16.2f} {:16.2f}'.format(
+            b, activation_memory(b, False, shape) / 2**20, mems[-1] / 2**20))
+    growth = mems[-1] / mems[0] - 1
+    ok = growth <= args.mem_tol
+    failed |= not ok
+    print('reversible activation memory growth {:+.1%} {}'.format(growth, 'ok' if ok else 'FAILED'))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+'''Compare tiled and whole-image inference of netG in both directions.
+
+    python scripts/check_tiled.py -opt options/test/test_IRN_x4.yml -img img.png -tile 256
+
+-tile and -overlap are HR pixels as test: tile_size and tile_overlap, the reverse pass
+tiles the LR input with them divided by the scale. Needs trained weights: the last convs
+of a fresh netG are zero, every block is the identity and the tiled output trivially
+exact, and randomly drawn ones are not smooth enough for the tolerance.
+'''
+import argparse
+import math
+import sys
+
+import cv2
+import numpy as np
+import torch
+
+from bench_util import load_netG
+
+
+def psnr(a, b):
+    mse = torch.mean((a - b)**2).item()
+    return float('inf') if mse == 0 else 10 * math.log10(1. / mse)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-opt', type=str, required=True, help='Path to test options YMAL file.')
+    parser.add_argument('-model', type=str, default=None, help='Override pretrain_model_G.')
+    parser.add_argument('-img', type=str, default=None, help='HR image, random if not given.')
+    parser.add_argument('-size', type=int, default=512, help='Size of the random HR image.')
+    parser.add_argument('-tile', type=int, default=256)
+    parser.add_argument('-overlap', type=int, default=32)
+    parser.add_argument('-min_psnr', type=float, default=40.)
+    parser.add_argument('-cpu', action='store_true')
+    args = parser.parse_args()
+
+    if args.model == 'none':
+        parser.error('check_tiled.py needs trained weights.')
+    opt, model, netG = load_netG(args.opt, args.model, args.cpu)
+    if not opt['path']['pretrain_model_G']:
+        parser.error('check_tiled.py needs trained weights, set pretrain_model_G or -model.')
+    scale = opt['scale']
+    if args.img:
+        img = cv2.imread(args.img, cv2.IMREAD_COLOR)[:, :, [2, 1, 0]].astype(np.float32) / 255.
+        H, W = img.shape[0] // scale * scale, img.shape[1] // scale * scale
+        x = torch.from_numpy(np.ascontiguousarray(img[:H, :W].transpose(2, 0, 1)))[None]
+    else:
+        x = torch.rand(1, 3, args.size, args.size)
+    x = x.to(model.device)
+
+    torch.manual_seed(0)
+    with torch.no_grad():
+        y = netG(x)
+        y_tiled = netG.tiled_forward(x, tile_size=args.tile, tile_overlap=args.overlap)
+        z = torch.cat((y[:, :3], torch.randn_like(y[:, 3:])), 1)
+        x_rev = netG(z, rev=True)
+        x_rev_tiled = netG.tiled_forward(z, rev=True, tile_size=args.tile // scale,
+                                         tile_overlap=args.overlap // scale)
+
+    ok = True
+    for name, a, b in [('forward', y, y_tiled), ('reverse', x_rev, x_rev_tiled)]:
+        diff = (a - b).abs()
+        p = psnr(a[:, :3], b[:, :3])
+        ok = ok and p >= args.min_psnr
+        print('{:8s} max abs diff: {:.3e}, mean abs diff: {:.3e}, PSNR: {:.2f} dB'.format(
+            name, diff.max().item(), diff.mean().item(), p))
+    if not ok:
+        print('Tiled inference is below the {:.1f} dB tolerance.'.format(args.min_psnr))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
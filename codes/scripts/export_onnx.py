@@ -0,0 +1,135 @@
+'''Export the downscaling and upscaling graphs of a trained InvRescaleNet to ONNX.
+
+    python scripts/export_onnx.py -opt options/test/test_IRN_x4.yml -out ../onnx/IRN_x4 -check
+
+writes <out>_down.onnx: HR -> quantized LR, and <out>_up.onnx: (LR, z) -> HR, or LR -> HR
+with -z internal, where z is drawn inside the graph. Both have dynamic batch, H and W.
+-check compares the onnxruntime outputs with PyTorch and exits nonzero when the HR
+difference exceeds -tol or the LR one exceeds one quantization level plus -tol. The z
+drawn inside a -z internal graph cannot be reproduced, its HR is checked on the same
+graph exported with gaussian_scale 0 against PyTorch with z = 0.
+'''
+import argparse
+import os.path as osp
+import sys
+import tempfile
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from bench_util import load_netG
+from models.modules.Inv_arch import HaarDownsampling
+
+
+class Downscaler(nn.Module):
+    '''HR -> LR, with the clamp and 8-bit rounding of the Quantization module'''
+    def __init__(self, net):
+        super(Downscaler, self).__init__()
+        self.net = net
+
+    def forward(self, hr):
+        lr = self.net.downscale(hr, inplace=False)
+        return torch.round(torch.clamp(lr, 0, 1) * 255.) / 255.
+
+
+class Upscaler(nn.Module):
+    '''(LR, z) -> HR, or LR -> HR with z ~ N(0, gaussian_scale^2) drawn in the graph'''
+    def __init__(self, net, scale, z_input=True, gaussian_scale=1.):
+        super(Upscaler, self).__init__()
+        self.net = net
+        self.z_channels = scale**2 - 1
+        self.z_input = z_input
+        self.gaussian_scale = gaussian_scale
+
+    def forward(self, lr, z=None):
+        if not self.z_input:
+            z = torch.randn_like(lr.repeat(1, self.z_channels, 1, 1)) * self.gaussian_scale
+        return self.net(torch.cat((lr, z), 1), rev=True, stateless=True)[:, :3]
+
+
+def export(netG, scale, out, z_input=True, gaussian_scale=1., opset=17):
+    # the conv Haar path is bit-identical and exports to a plain Conv/ConvTranspose
+    for m in netG.modules():
+        if isinstance(m, HaarDownsampling):
+            m.use_conv = True
+
+    hr = torch.rand(1, 3, 16 * scale, 16 * scale)
+    lr = torch.rand(1, 3, 16, 16)
+    z = torch.randn(1, 3 * (scale**2 - 1), 16, 16)
+    spatial = {0: 'batch', 2: 'height', 3: 'width'}
+
+    with torch.no_grad():
+        torch.onnx.export(Downscaler(netG), (hr, ), out + '_down.onnx', opset_version=opset,
+                          input_names=['HR'], output_names=['LR'],
+                          dynamic_axes={'HR': spatial, 'LR': spatial}, dynamo=False)
+        upscaler = Upscaler(netG, scale, z_input, gaussian_scale)
+        if z_input:
+            torch.onnx.export(upscaler, (lr, z), out + '_up.onnx', opset_version=opset,
+                              input_names=['LR', 'z'], output_names=['HR'],
+                              dynamic_axes={'LR': spatial, 'z': spatial, 'HR': spatial},
+                              dynamo=False)
+        else:
+            torch.onnx.export(upscaler, (lr, ), out + '_up.onnx', opset_version=opset,
+                              input_names=['LR'], output_names=['HR'],
+                              dynamic_axes={'LR': spatial, 'HR': spatial}, dynamo=False)
+
+
+def check(netG, scale, out, z_input=True, opset=17, sizes=((32, 48), (40, 24))):
+    '''Max abs difference between onnxruntime and PyTorch on random inputs'''
+    import onnxruntime as ort
+    down = ort.InferenceSession(out + '_down.onnx', providers=['CPUExecutionProvider'])
+    up_path = out + '_up.onnx'
+    if not z_input:
+        up_path = osp.join(tempfile.mkdtemp(), 'zero_z')
+        export(netG, scale, up_path, False, 0., opset)
+        up_path += '_up.onnx'
+    up = ort.InferenceSession(up_path, providers=['CPUExecutionProvider'])
+    diffs = []
+    for h, w in sizes:
+        hr = torch.rand(1, 3, h * scale, w * scale)
+        z = torch.randn(1, 3 * (scale**2 - 1), h, w)
+        if not z_input:
+            z.zero_()
+        with torch.no_grad():
+            lr_ref = Downscaler(netG)(hr)
+            hr_ref = Upscaler(netG, scale)(lr_ref, z)
+        lr = down.run(None, {'HR': hr.numpy()})[0]
+        # rounding may flip by one level where the float results straddle a boundary
+        d_lr = np.abs(lr - lr_ref.numpy()).max()
+        feed = {'LR': lr_ref.numpy(), 'z': z.numpy()} if z_input else {'LR': lr_ref.numpy()}
+        d_hr = np.abs(up.run(None, feed)[0] - hr_ref.numpy()).max()
+        print('{:d}x{:d} LR max abs diff: {:.3e}, HR max abs diff: {:.3e}'.format(
+            h * scale, w * scale, d_lr, d_hr))
+        diffs.append((d_lr, d_hr))
+    return diffs
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-opt', type=str, required=True, help='Path to test options YMAL file.')
+    parser.add_argument('-model', type=str, default=None,
+                        help='Override pretrain_model_G, none for random weights.')
+    parser.add_argument('-out', type=str, required=True, help='Output path prefix.')
+    parser.add_argument('-z', type=str, default='input', choices=['input', 'internal'],
+                        help='Feed z as a graph input or draw it inside the graph.')
+    parser.add_argument('-gaussian_scale', type=float, default=1.)
+    parser.add_argument('-opset', type=int, default=17)
+    parser.add_argument('-check', action='store_true', help='Parity check with onnxruntime.')
+    parser.add_argument('-tol', type=float, default=1e-3, help='Max abs difference of -check.')
+    args = parser.parse_args()
+
+    opt, model, netG = load_netG(args.opt, args.model, cpu=True)
+    z_input = args.z == 'input'
+    export(netG, opt['scale'], args.out, z_input, args.gaussian_scale, args.opset)
+    print('Exported {0}_down.onnx and {0}_up.onnx'.format(args.out))
+    if args.check:
+        diffs = check(netG, opt['scale'], args.out, z_input, args.opset)
+        # rounding may flip the quantized LR by one level; NaN differences fail
+        if not all(d_lr <= 1. / 255 + args.tol and d_hr <= args.tol for d_lr, d_hr in diffs):
+            print('Parity check failed: max abs diff above the tolerance {:.1e}.'.format(args.tol))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+'''Structured pruning of the growth channels of the DenseBlock subnets, with fine-tuning.
+
+Growth channels of conv1 to conv4 in every F, G and H DenseBlock are scored by their
+mean |activation| on training batches times the norm of the weights reading them.
+The lowest scoring channels are removed, -multiple at a time so the widths stay
+multiples of it, until the DenseBlock MACs drop by -target.
+The pruned model is then fine-tuned for -niter iterations with the IRNModel losses
+of the training option file.
+
+    python scripts/prune_subnets.py -opt options/train/train_IRN_x4.yml \\
+        -model ../experiments/pretrained_models/IRN_x4.pth -target 0.5 -niter 20000 \\
+        -save ../experiments/pretrained_models/IRN_x4_pruned.pth
+
+The saved state_dict has the smaller convs and marks every pruned DenseBlock with its
+widths (<block>.pruned_widths); define_G builds the full network and the marked blocks
+take over these widths on load, so pretrain_model_G can point to it in any test or
+training option file with the same gc (longer fine-tuning runs go through train.py).
+Unmarked checkpoints of other widths still fail to load.
+fuse_gh does not support pruned blocks.
+'''
+import argparse
+
+import torch
+
+from bench_util import count_macs, timeit, train_iters, validate
+import options.options as option
+import utils.util as util
+from data import create_dataloader, create_dataset
+from models import create_model
+from models.modules import prune_util
+
+
+def calibrate(model, train_loader, n_batches):
+    stats = prune_util.ActivationStats(model.netG.module)
+    for i, train_data in enumerate(train_loader):
+        if i >= n_batches:
+            break
+        model.feed_data(train_data)
+        model.test()  # forward and reverse pass
+    stats.remove()
+    return stats
+
+
+def cost(model, size, repeat):
+    '''MACs and forward + reverse latency of netG on one HR image'''
+    netG = model.netG.module
+    H, W = [int(v) for v in size.split('x')]
+    scale = model.opt['scale']
+    x = torch.rand(1, 3, H, W, device=model.device)
+    y = torch.rand(1, 3 * scale**2, H // scale, W // scale, device=model.device)
+    netG.eval()
+    with torch.no_grad():
+        t_forw = timeit(lambda: netG(x, stateless=True), repeat)
+        t = t_forw + timeit(lambda: netG(y, rev=True, stateless=True), repeat)
+    netG.train()
+    macs = count_macs(netG, x, stateless=True) + count_macs(netG, y, rev=True, stateless=True)
+    return macs, t
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-opt', type=str, required=True, help='Path to training options YMAL file.')
+    parser.add_argument('-model', type=str, default=None, help='Override pretrain_model_G.')
+    parser.add_argument('-target', type=float, default=0.5,
+                        help='Fraction of DenseBlock MACs to remove.')
+    parser.add_argument('-min_channels', type=int, default=4,
+                        help='Growth channels kept per conv at least.')
+    parser.add_argument('-multiple', type=int, default=8, help='Keep widths multiples of this.')
+    parser.add_argument('-calib_batches', type=int, default=16)
+    parser.add_argument('-niter', type=int, default=0, help='Fine-tuning iterations.')
+    parser.add_argument('-n_val', type=int, default=None, help='Validate on the first n images.')
+    parser.add_argument('-bench_size', type=str, default='256x256', help='HR size for timing.')
+    parser.add_argument('-repeat', type=int, default=3)
+    parser.add_argument('-save', type=str, required=True,
+                        help='Where to save the pruned state_dict.')
+    parser.add_argument('-cpu', action='store_true')
+    args = parser.parse_args()
+
+    opt = option.dict_to_nonedict(option.parse(args.opt, is_train=True))
+    opt['dist'] = False
+    opt['path']['resume_state'] = None
+    if args.model is not None:
+        opt['path']['pretrain_model_G'] = args.model
+    seed = opt['train']['manual_seed'] if opt['train']['manual_seed'] is not None else 10
+    util.set_random_seed(seed)
+    for phase, dataset_opt in opt['datasets'].items():
+        if phase == 'train':
+            train_loader = create_dataloader(create_dataset(dataset_opt), dataset_opt, opt, None)
+        elif phase == 'val':
+            val_loader = create_dataloader(create_dataset(dataset_opt), dataset_opt, opt, None)
+    if args.cpu:
+        opt['gpu_ids'] = None
+
+    rows = []
+    model = create_model(opt)
+    rows.append(('original', *cost(model, args.bench_size, args.repeat),
+                 validate(model, val_loader, args.n_val)))
+
+    stats = calibrate(model, train_loader, args.calib_batches)
+    netG = model.netG.module
+    with torch.no_grad():
+        plan = prune_util.plan(netG, stats, args.target, args.min_channels, args.multiple)
+        prune_util.prune(netG, plan)
+    torch.save(netG.state_dict(), args.save)
+    rows.append(('pruned', *cost(model, args.bench_size, args.repeat),
+                 validate(model, val_loader, args.n_val)))
+
+    if args.niter > 0:
+        # a fresh model loads the pruned checkpoint through define_G, as any later user would
+        opt['path']['pretrain_model_G'] = args.save
+        model = create_model(opt)
+        train_iters(model, train_loader, args.niter, opt['train']['warmup_iter'])
+        torch.save(model.netG.module.state_dict(), args.save)
+        rows.append(('fine-tuned', *cost(model, args.bench_size, args.repeat),
+                     validate(model, val_loader, args.n_val)))
+
+    print('{:>12s} {:>10s} {:>10s} {:>8s}'.format('', 'GMACs', 'ms', 'PSNR'))
+    for name, macs, t, psnr in rows:
+        print('{:>12s} {:10.2f} {:10.1f} {:8.2f}'.format(name, macs / 1e9, t * 1e3, psnr))
+    print('Saved {:s}'.format(args.save))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+'''Post-training INT8 quantization of the DenseBlock convs of a trained IRN model (CPU).
+
+Calibrates activation ranges on a folder of HR images (e.g. the DIV2K val set) with
+forward and reverse passes, converts the DenseBlocks to int8, saves the quantized
+state_dict and reports the PSNR/SSIM cost and the speedup against the float model.
+The Haar transform and the coupling arithmetic stay in float.
+
+    python scripts/quantize_ptq.py -opt options/test/test_IRN_x4.yml -calib DIV2K_valid_HR \\
+        -eval Set5/HR -save ../experiments/IRN_x4_int8.pth
+
+-qat compares against an int8 model exported by a train: qat run of the same float model.
+'''
+import argparse
+import copy
+
+import numpy as np
+import torch
+
+from bench_util import load_netG, timeit
+import data.util as data_util
+import utils.util as util
+from models.modules import quant_util
+
+
+def load_hr(path, scale, crop=None):
+    img = data_util.modcrop(data_util.read_img(None, path), scale)
+    if crop:  # center crop, keeps calibration cheap on large images
+        H, W, _ = img.shape
+        h, w = min(crop, H) // scale * scale, min(crop, W) // scale * scale
+        top, left = (H - h) // 2 // scale * scale, (W - w) // 2 // scale * scale
+        img = img[top:top + h, left:left + w]
+    img = img[:, :, [2, 1, 0]]
+    return torch.from_numpy(np.ascontiguousarray(np.transpose(img, (2, 0, 1)))).float()[None]
+
+
+def run(netG, hr, z):
+    '''HR -> quantized LR -> HR with the given z'''
+    lr = netG.downscale(hr)
+    lr = torch.round(torch.clamp(lr, 0, 1) * 255.) / 255.
+    sr = netG(torch.cat((lr, z), 1), rev=True, inplace=True)[:, :3]
+    return lr, sr
+
+
+def evaluate(netG, paths, scale, crop_border):
+    psnr_sr, ssim_sr, psnr_lr = [], [], []
+    for i, path in enumerate(paths):
+        hr = load_hr(path, scale)
+        torch.manual_seed(i)
+        z = torch.randn(1, 3 * (scale**2 - 1), hr.shape[2] // scale, hr.shape[3] // scale)
+        with torch.no_grad():
+            lr, sr = run(netG, hr, z)
+        gt_img, sr_img = util.tensor2img(hr[0]), util.tensor2img(sr[0])
+        lr_img = util.tensor2img(lr[0])
+        lr_ref = util.tensor2img(
+            torch.from_numpy(data_util.imresize_np(hr[0].numpy().transpose(1, 2, 0), 1 / scale,
+                                                   True).transpose(2, 0, 1)))
+        c = crop_border
+        psnr_sr.append(util.calculate_psnr(sr_img[c:-c, c:-c], gt_img[c:-c, c:-c]))
+        ssim_sr.append(util.calculate_ssim(sr_img[c:-c, c:-c], gt_img[c:-c, c:-c]))
+        psnr_lr.append(util.calculate_psnr(lr_img, lr_ref))
+    return np.mean(psnr_sr), np.mean(ssim_sr), np.mean(psnr_lr)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-opt', type=str, required=True, help='Path to test options YMAL file.')
+    parser.add_argument('-model', type=str, default=None,
+                        help='Override pretrain_model_G, none for random weights.')
+    parser.add_argument('-calib', type=str, required=True, help='Folder of calibration HR images.')
+    parser.add_argument('-n_calib', type=int, default=32)
+    parser.add_argument('-calib_crop', type=int, default=256)
+    parser.add_argument('-eval', type=str, default=None, help='Folder of evaluation HR images.')
+    parser.add_argument('-bench_size', type=str, default='512x512', help='HR size for timing.')
+    parser.add_argument('-backend', type=str, default='x86', choices=['x86', 'fbgemm', 'qnnpack'])
+    parser.add_argument('-save', type=str, default=None, help='Where to save the int8 state_dict.')
+    parser.add_argument('-qat', type=str, default=None,
+                        help='An exported *_G_int8.pth of a QAT run, evaluated next to PTQ.')
+    args = parser.parse_args()
+
+    opt, model, netG = load_netG(args.opt, args.model, cpu=True)
+    scale = opt['scale']
+    qnet = quant_util.prepare_ptq(copy.deepcopy(netG), args.backend)
+
+    # calibrate both directions, upscaling reads the subnets with other activations
+    calib_paths = data_util._get_paths_from_images(args.calib)[:args.n_calib]
+    for i, path in enumerate(calib_paths):
+        hr = load_hr(path, scale, args.calib_crop)
+        torch.manual_seed(i)
+        z = torch.randn(1, 3 * (scale**2 - 1), hr.shape[2] // scale, hr.shape[3] // scale)
+        with torch.no_grad():
+            run(qnet, hr, z)
+    quant_util.convert(qnet)
+    print('Calibrated on {:d} images.'.format(len(calib_paths)))
+    if args.save:
+        torch.save(qnet.state_dict(), args.save)
+        print('Saved int8 model to {:s}'.format(args.save))
+
+    if args.eval:
+        eval_paths = data_util._get_paths_from_images(args.eval)
+        crop_border = opt['crop_border'] if opt['crop_border'] else scale
+        fp = evaluate(netG, eval_paths, scale, crop_border)
+        q = evaluate(qnet, eval_paths, scale, crop_border)
+        print('{:>6s} {:>10s} {:>10s} {:>12s}'.format('', 'PSNR (dB)', 'SSIM', 'LR PSNR (dB)'))
+        print('{:>6s} {:10.4f} {:10.4f} {:12.4f}'.format('fp32', *fp))
+        print('{:>6s} {:10.4f} {:10.4f} {:12.4f}'.format('int8', *q))
+        print('{:>6s} {:10.4f} {:10.4f} {:12.4f}'.format('cost', *(np.array(fp) - np.array(q))))
+        if args.qat:
+            qat_net = quant_util.load_quantized(copy.deepcopy(netG), args.qat, args.backend)
+            q = evaluate(qat_net, eval_paths, scale, crop_border)
+            print('{:>6s} {:10.4f} {:10.4f} {:12.4f}'.format('qat', *q))
+            print('{:>6s} {:10.4f} {:10.4f} {:12.4f}'.format('cost', *(np.array(fp) - np.array(q))))
+
+    H, W = [int(v) for v in args.bench_size.split('x')]
+    hr = torch.rand(1, 3, H, W)
+    y = torch.rand(1, 3 * scale**2, H // scale, W // scale)
+    print('{:>10s} {:>10s} {:>10s} {:>8s}'.format('', 'fp32 (ms)', 'int8 (ms)', 'speedup'))
+    with torch.no_grad():
+        cases = [('downscale', lambda: netG.downscale(hr), lambda: qnet.downscale(hr)),
+                 ('upscale', lambda: netG(y, rev=True, inplace=True),
+                  lambda: qnet(y, rev=True, inplace=True))]
+        for name, fn_fp, fn_q in cases:
+            t_fp, t_q = timeit(fn_fp, 3), timeit(fn_q, 3)
+            print('{:>10s} {:10.1f} {:10.1f} {:8.2f}'.format(
+                name, t_fp * 1e3, t_q * 1e3, t_fp / t_q))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+'''Latency-aware search over block_num and gc.
+
+1. Latency lookup table: one InvBlockExp per level and gc, and the Haar transforms, are
+   timed in both directions on the reference HR sizes. The latency of a configuration
+   is predicted as the sum of its ops, so any block_num is priced without building it.
+   -measure also times the full networks to report the prediction error.
+2. Proxy training: every configuration is trained from scratch for -proxy_iter
+   iterations with the losses and settings of the training option file, then
+   validated (SR PSNR on the val set, borders of scale pixels cropped as in train.py).
+3. The PSNR / latency Pareto front is printed, and -target_psnr picks the fastest
+   configuration of the front that reaches the target.
+
+    python scripts/search_arch.py -opt options/train/train_IRN_x4.yml -blocks 2 4 6 8 \\
+        -gc 16 24 32 -sizes 256x256 512x512 -proxy_iter 2000 -save search_x4.json
+
+A block count applies to every level, "4,8" sets them per level. The Pareto front uses
+the forward + reverse latency at the first size. -lut reuses the table of an earlier
+-save on the same machine, -proxy_iter 0 only builds the table and the predictions.
+'''
+import argparse
+import itertools
+import json
+
+import numpy as np
+import torch
+
+from bench_util import timeit, train_iters, validate
+import options.options as option
+import utils.util as util
+from data import create_dataloader, create_dataset
+from models import create_model
+from models.modules.Inv_arch import InvBlockExp
+
+
+def parse_blocks(s, down_num):
+    blocks = [int(v) for v in s.split(',')]
+    return blocks * down_num if len(blocks) == 1 else blocks
+
+
+def load_opt(opt_path, block_num, gc, cpu, is_train=True):
+    opt = option.parse(opt_path, is_train=is_train)
+    opt['network_G']['block_num'] = block_num
+    opt['network_G']['which_model_G']['gc'] = gc
+    opt = option.dict_to_nonedict(opt)
+    opt['dist'] = False
+    if cpu:
+        opt['gpu_ids'] = None
+    return opt
+
+
+def build_lut(opt_path, gcs, sizes, cpu, repeat):
+    '''{"gc/level/HxW/direction": seconds}, "haar" for the level transform'''
+    lut = {}
+    down_num = int(np.log2(option.parse(opt_path, is_train=False)['scale']))
+    for gc in gcs:
+        opt = load_opt(opt_path, [1] * down_num, gc, cpu, is_train=False)
+        opt['path']['pretrain_model_G'] = None
+        model = create_model(opt)
+        netG = model.netG.module
+        netG.eval()
+        for size in sizes:
+            H, W = [int(v) for v in size.split('x')]
+            x = torch.rand(1, opt['network_G']['in_nc'], H, W, device=model.device)
+            level = -1
+            for op in netG.operations:
+                if isinstance(op, InvBlockExp):
+                    name = '{}/{}'.format(gc, level)
+                else:
+                    level += 1
+                    name = 'haar/{}'.format(level)
+                with torch.no_grad():
+                    y = op.stateless_forward(x)[0]
+                    key = '{}/{}/'.format(name, size)
+                    lut[key + 'forward'] = timeit(lambda: op.stateless_forward(x), repeat)
+                    lut[key + 'reverse'] = timeit(lambda: op.stateless_forward(y, True), repeat)
+                x = y
+    return lut
+
+
+def predict(lut, block_num, gc, size):
+    t = 0
+    for level, n in enumerate(block_num):
+        for direction in ('forward', 'reverse'):
+            t += lut['haar/{}/{}/{}'.format(level, size, direction)]
+            t += n * lut['{}/{}/{}/{}'.format(gc, level, size, direction)]
+    return t
+
+
+def measure(opt_path, block_num, gc, size, cpu, repeat):
+    opt = load_opt(opt_path, block_num, gc, cpu, is_train=False)
+    opt['path']['pretrain_model_G'] = None
+    model = create_model(opt)
+    netG = model.netG.module
+    netG.eval()
+    H, W = [int(v) for v in size.split('x')]
+    scale = opt['scale']
+    x = torch.rand(1, 3, H, W, device=model.device)
+    y = torch.rand(1, 3 * scale**2, H // scale, W // scale, device=model.device)
+    with torch.no_grad():
+        t_forw = timeit(lambda: netG(x, stateless=True), repeat)
+        return t_forw + timeit(lambda: netG(y, rev=True, stateless=True), repeat)
+
+
+def proxy_train(opt_path, block_num, gc, cpu, niter, n_val, seed):
+    '''Trains a configuration from scratch for niter iterations, returns the val PSNR'''
+    opt = load_opt(opt_path, block_num, gc, False)
+    opt['path']['pretrain_model_G'] = None
+    opt['path']['resume_state'] = None
+    util.set_random_seed(seed)
+    for phase, dataset_opt in opt['datasets'].items():
+        if phase == 'train':
+            train_loader = create_dataloader(create_dataset(dataset_opt), dataset_opt, opt, None)
+        elif phase == 'val':
+            val_loader = create_dataloader(create_dataset(dataset_opt), dataset_opt, opt, None)
+    if cpu:
+        opt['gpu_ids'] = None
+    model = create_model(opt)
+
+    train_iters(model, train_loader, niter, opt['train']['warmup_iter'])
+    return validate(model, val_loader, n_val)
+
+
+def pareto_front(results):
+    '''Results that no other result beats in both latency and PSNR, fastest first'''
+    front = []
+    for r in sorted(results, key=lambda r: (r['latency'], -r['psnr'])):
+        if not front or r['psnr'] > front[-1]['psnr']:
+            front.append(r)
+    return front
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-opt', type=str, required=True, help='Path to training options YMAL file.')
+    parser.add_argument('-blocks', type=str, nargs='+', default=['2', '4', '8'],
+                        help='Blocks per level, "4" for all levels or "4,8" per level.')
+    parser.add_argument('-gc', type=int, nargs='+', default=[16, 24, 32])
+    parser.add_argument('-sizes', type=str, nargs='+', default=['256x256'], help='HR sizes, HxW.')
+    parser.add_argument('-lut', type=str, default=None, help='Latency table of an earlier -save.')
+    parser.add_argument('-measure', action='store_true', help='Also time the full networks.')
+    parser.add_argument('-proxy_iter', type=int, default=2000)
+    parser.add_argument('-n_val', type=int, default=None, help='Validate on the first n images.')
+    parser.add_argument('-target_psnr', type=float, default=None)
+    parser.add_argument('-repeat', type=int, default=5)
+    parser.add_argument('-seed', type=int, default=10)
+    parser.add_argument('-save', type=str, default=None,
+                        help='Write the table and results as JSON.')
+    parser.add_argument('-cpu', action='store_true')
+    args = parser.parse_args()
+
+    down_num = int(np.log2(option.parse(args.opt, is_train=False)['scale']))
+    configs = [(parse_blocks(b, down_num), gc) for b, gc in itertools.product(args.blocks, args.gc)]
+
+    if args.lut:
+        with open(args.lut) as f:
+            lut = json.load(f)['lut']
+    else:
+        lut = build_lut(args.opt, args.gc, args.sizes, args.cpu, args.repeat)
+
+    results = []
+    for block_num, gc in configs:
+        r = {'block_num': block_num, 'gc': gc}
+        r['predicted'] = {s: predict(lut, block_num, gc, s) for s in args.sizes}
+        if args.measure:
+            r['measured'] = {s: measure(args.opt, block_num, gc, s, args.cpu, args.repeat)
+                             for s in args.sizes}
+        r['latency'] = (r['measured'] if args.measure else r['predicted'])[args.sizes[0]]
+        if args.proxy_iter > 0:
+            r['psnr'] = proxy_train(args.opt, block_num, gc, args.cpu, args.proxy_iter,
+                                    args.n_val, args.seed)
+        results.append(r)
+
+    print('{:>10s} {:>4s} {:>10s} {:>14s} {:>14s} {:>8s}'.format(
+        'block_num', 'gc', 'size', 'predicted(ms)', 'measured(ms)', 'PSNR'))
+    for r in results:
+        for s in args.sizes:
+            measured = '{:>14s}'.format('-')
+            if args.measure:
+                measured = '{:14.1f}'.format(r['measured'][s] * 1e3)
+            psnr = '{:8.2f}'.format(r['psnr']) if 'psnr' in r else '{:>8s}'.format('-')
+            print('{:>10s} {:4d} {:>10s} {:14.1f} {:s} {:s}'.format(
+                ','.join(str(b) for b in r['block_num']), r['gc'], s, r['predicted'][s] * 1e3,
+                measured, psnr))
+    if args.measure:
+        err = [abs(r['predicted'][s] / r['measured'][s] - 1) for r in results for s in args.sizes]
+        print('Latency prediction error: mean {:.1f}%, max {:.1f}%'.format(
+            np.mean(err) * 100, np.max(err) * 100))
+
+    if args.proxy_iter > 0:
+        front = pareto_front(results)
+        print('Pareto front ({:s}, forward + reverse):'.format(args.sizes[0]))
+        for r in front:
+            print('  block_num {:s} gc {:d}: {:.1f} ms, {:.2f} dB'.format(
+                str(r['block_num']), r['gc'], r['latency'] * 1e3, r['psnr']))
+        if args.target_psnr is not None:
+            ok = [r for r in front if r['psnr'] >= args.target_psnr]
+            if ok:
+                print('Fastest with PSNR >= {:.2f}: block_num {:s} gc {:d}'.format(
+                    args.target_psnr, str(ok[0]['block_num']), ok[0]['gc']))
+            else:
+                print('No configuration reaches {:.2f} dB.'.format(args.target_psnr))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'lut': lut, 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+'''Stress test for stateless InvRescaleNet execution shared by several threads.
+
+Every worker thread runs forward and reverse passes with stateless=True on one shared
+netG and compares the outputs and the log-determinants against serial execution.
+
+    python scripts/stress_concurrent.py -opt options/test/test_IRN_x4.yml -threads 8
+'''
+import argparse
+import random
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+from bench_util import load_netG
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-opt', type=str, required=True, help='Path to test options YMAL file.')
+    parser.add_argument('-model', type=str, default=None,
+                        help='Override pretrain_model_G, none for random weights.')
+    parser.add_argument('-threads', type=int, default=8)
+    parser.add_argument('-requests', type=int, default=64)
+    parser.add_argument('-inputs', type=int, default=6, help='Number of distinct inputs.')
+    parser.add_argument('-cpu', action='store_true')
+    args = parser.parse_args()
+
+    opt, model, netG = load_netG(args.opt, args.model, args.cpu)
+    scale = opt['scale']
+    torch.manual_seed(0)
+
+    # inputs of different sizes, for both directions
+    cases = []
+    for i in range(args.inputs):
+        size = scale * random.choice([8, 12, 16, 24])
+        hr = torch.rand(1, 3, size, size, device=model.device)
+        lr = torch.rand(1, 3 * scale**2, size // scale, size // scale, device=model.device)
+        cases.append((hr, False))
+        cases.append((lr, True))
+
+    with torch.no_grad():
+        expected = [netG(x, rev=rev, cal_jacobian=True, stateless=True) for x, rev in cases]
+
+    def run(i):
+        x, rev = cases[i]
+        with torch.no_grad():
+            out, jac = netG(x, rev=rev, cal_jacobian=True, stateless=True)
+        exp_out, exp_jac = expected[i]
+        return (out - exp_out).abs().max().item(), abs(float(jac) - float(exp_jac))
+
+    order = [random.randrange(len(cases)) for _ in range(args.requests)]
+    with ThreadPoolExecutor(max_workers=args.threads) as pool:
+        results = list(pool.map(run, order))
+
+    max_out = max(r[0] for r in results)
+    max_jac = max(r[1] for r in results)
+    print('{:d} requests on {:d} threads: max output diff {:.3e}, max jacobian diff {:.3e}'.format(
+        args.requests, args.threads, max_out, max_jac))
+    if max_out > 1e-5 or max_jac > 1e-3:
+        print('Concurrent results differ from serial execution.')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
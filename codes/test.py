@@ -99,6 +99,9 @@ for test_loader in test_loaders:
 
         lr_img = lr_img / 255.
         lrgt_img = lrgt_img / 255.
+        # sizes that are not multiples of the scale give a ceil(H / scale) LR, an LR_ref
+        # made with floor(H / scale) is a row / column smaller
+        lr_img = lr_img[:lrgt_img.shape[0], :lrgt_img.shape[1]]
 
         crop_border = opt['crop_border'] if opt['crop_border'] else opt['scale']
         if crop_border == 0: